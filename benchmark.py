@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+#############################################
+## STAG benchmark                           #
+## synthetic library and per-stage timings  #
+#############################################
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from stag import SKTagger
+from xmphandler import XMPHandler
+from sidecarwriter import SidecarWriter
+from tagindex import TagIndex
+from scanner import DirectoryScanner
+from precision import InferenceMode
+from modelstore import ModelStore
+
+SIDECAR_TEMPLATE = """<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 4.4.0-Exiv2">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+    xmlns:xmpMM="http://ns.adobe.com/xap/1.0/mm/"
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:lr="http://ns.adobe.com/lightroom/1.0/"
+    xmp:Rating="%(rating)d"
+    xmpMM:DerivedFrom="%(image)s">
+   <dc:subject>
+    <rdf:%(layout)s>
+%(subjects)s
+    </rdf:%(layout)s>
+   </dc:subject>
+   <lr:hierarchicalSubject>
+    <rdf:%(layout)s>
+%(hierarchical)s
+    </rdf:%(layout)s>
+   </lr:hierarchicalSubject>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+"""
+
+KEYWORDS = ["holiday", "family", "garden", "beach", "mountain", "city", "night", "portrait"]
+STUB_TAGS = ["tree", "sky", "person", "car", "water", "house", "dog", "cat", "flower", "road"]
+
+
+class StubModel(torch.nn.Module):
+    """
+    Stands in for RAM++ with the same generate_tag interface, so everything but the model can be
+    benchmarked without downloading it. Tags depend on the image, but mean nothing.
+    """
+
+    def __init__(self):
+        super().__init__()
+        generator = torch.Generator().manual_seed(0)
+        self.pool = torch.nn.AdaptiveAvgPool2d(8)
+        self.fc = torch.nn.Linear(3 * 8 * 8, len(STUB_TAGS))
+        with torch.no_grad():
+            self.fc.weight.copy_(torch.randn(self.fc.weight.shape, generator=generator))
+            self.fc.bias.zero_()
+
+    def generate_tag(self, image):
+        scores = self.fc(self.pool(image).flatten(1))
+        tags = [" | ".join(STUB_TAGS[i] for i in range(len(STUB_TAGS)) if row[i] > 0) for row in scores.tolist()]
+        return tags, tags
+
+
+class SyntheticLibrary:
+    """
+    A reproducible image library: the same seed and settings always give the same files.
+    Images are spread over a few directories and come in all formats and sizes, with no sidecar,
+    a sidecar using rdf:Bag or one using rdf:Seq, some of them already tagged with the prefix.
+    """
+
+    MANIFEST = ".stag_benchmark.json"
+    FORMATS = {"jpeg": ("jpg", "JPEG"), "png": ("png", "PNG"), "tiff": ("tif", "TIFF"), "heic": ("heic", "HEIF")}
+    LAYOUTS = ["none", "Bag", "Seq"]
+
+    def __init__(self, root, images=120, sizes=((640, 480), (1920, 1280), (4000, 3000)),
+                 formats=("jpeg", "png", "tiff", "heic"), seed=0, prefix="st", directories=4):
+        self.root = root
+        self.images = images
+        self.sizes = [tuple(size) for size in sizes]
+        self.formats = list(formats)
+        self.seed = seed
+        self.prefix = prefix
+        self.directories = directories
+
+    def settings(self):
+        return {"images": self.images, "sizes": [list(size) for size in self.sizes], "formats": self.formats,
+                "seed": self.seed, "prefix": self.prefix, "directories": self.directories}
+
+    def is_generated(self):
+        try:
+            with open(os.path.join(self.root, SyntheticLibrary.MANIFEST)) as f:
+                return json.load(f)["settings"] == self.settings()
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def manifest(self):
+        with open(os.path.join(self.root, SyntheticLibrary.MANIFEST)) as f:
+            return json.load(f)
+
+    def generate(self):
+        if self.is_generated():
+            print("Using the library generated before in ", self.root)
+            return self.manifest()
+        print("Generating %d images in %s" % (self.images, self.root))
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self.root)
+        if "heic" in self.formats:
+            try:
+                from pillow_heif import register_heif_opener
+                register_heif_opener()
+            except ImportError:
+                print("pillow_heif is not installed, not generating HEIC files")
+                self.formats.remove("heic")
+
+        random = np.random.RandomState(self.seed)
+        counts = {}
+        for i in range(self.images):
+            image_format = self.formats[i % len(self.formats)]
+            size = self.sizes[(i // len(self.formats)) % len(self.sizes)]
+            layout = SyntheticLibrary.LAYOUTS[i % len(SyntheticLibrary.LAYOUTS)]
+            tagged = layout != "none" and i % 4 == 0
+            directory = os.path.join(self.root, "dir_%02d" % (i % self.directories))
+            os.makedirs(directory, exist_ok=True)
+            extension, pil_format = SyntheticLibrary.FORMATS[image_format]
+            image_file = os.path.join(directory, "IMG_%05d.%s" % (i, extension))
+            self.write_image(image_file, pil_format, size, random)
+            if layout != "none":
+                self.write_sidecar(image_file, layout, tagged, random)
+            key = "%s %dx%d %s%s" % (image_format, size[0], size[1], layout, " tagged" if tagged else "")
+            counts[key] = counts.get(key, 0) + 1
+
+        manifest = {"settings": self.settings(), "files": counts}
+        with open(os.path.join(self.root, SyntheticLibrary.MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=1)
+        return manifest
+
+    def write_image(self, image_file, pil_format, size, random):
+        # smooth color fields with a bit of noise, compress about like photos do
+        small = random.randint(0, 256, (6, 8, 3)).astype(np.uint8)
+        image = Image.fromarray(small).resize(size, Image.Resampling.BICUBIC)
+        noise = random.randint(-8, 9, (size[1], size[0], 1))
+        image = Image.fromarray(np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8))
+        options = {"quality": 90} if pil_format in ["JPEG", "HEIF"] else {}
+        if pil_format == "TIFF":
+            options = {"compression": "tiff_deflate"}
+        image.save(image_file, pil_format, **options)
+
+    def write_sidecar(self, image_file, layout, tagged, random):
+        keywords = sorted(random.choice(KEYWORDS, 3, replace=False))
+        hierarchical = ["places|" + k for k in keywords]
+        subjects = keywords
+        if tagged:
+            # what STAG writes: the prefix and the tags as keywords, and the tags below the prefix
+            tags = sorted(random.choice(STUB_TAGS, 3, replace=False))
+            subjects = subjects + [self.prefix] + tags
+            hierarchical += [self.prefix + "|" + t for t in tags]
+        content = SIDECAR_TEMPLATE % {
+            "rating": random.randint(0, 6), "image": os.path.basename(image_file), "layout": layout,
+            "subjects": "\n".join("     <rdf:li>%s</rdf:li>" % k for k in subjects),
+            "hierarchical": "\n".join("     <rdf:li>%s</rdf:li>" % h for h in hierarchical)}
+        with open(os.path.splitext(image_file)[0] + ".xmp", "w") as f:
+            f.write(content)
+
+
+class StageTimer:
+    # collects how often a stage ran and how long it took in total, from any thread
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage, count=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, count)
+
+    def add(self, stage, seconds, count=1):
+        with self.lock:
+            total, n = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, n + count)
+
+    def results(self):
+        return {stage: {"count": n, "seconds": round(total, 4),
+                        "ms_per_item": round(1000 * total / n, 3) if n > 0 else None,
+                        "items_per_s": round(n / total, 2) if total > 0 else None}
+                for stage, (total, n) in self.stages.items()}
+
+
+class Benchmark:
+    """
+    Runs the stages of tagging one after the other on every file of a library, timing each of them,
+    and then the complete pipeline via enter_dir, once on the untouched library and once more
+    when everything is tagged. Every run works on a fresh copy, the library itself stays unchanged.
+    """
+
+    def __init__(self, tagger, library, work_dir, prefix="st", verbose=False):
+        self.tagger = tagger
+        self.library = library
+        self.work_dir = work_dir
+        self.prefix = prefix
+        self.verbose = verbose
+
+    def output(self):
+        # the tagger prints a line for every file, which is slow on some terminals and clutters the results
+        if self.verbose:
+            return contextlib.nullcontext()
+        return contextlib.redirect_stdout(open(os.devnull, "w"))
+
+    def copy_library(self, name):
+        target = os.path.join(self.work_dir, name)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        shutil.copytree(self.library, target)
+        return target
+
+    def run_stages(self):
+        library = self.copy_library("stages")
+        timer = StageTimer()
+        tagger = self.tagger
+
+        start = time.perf_counter()
+        items = list(DirectoryScanner.scan(library))
+        timer.add("scan", time.perf_counter() - start, len(items))
+
+        batch = []
+        with self.output():
+            for item in items:
+                for sidecar in item.sidecars:
+                    with timer.measure("xmp_prefix_check"):
+                        XMPHandler.file_has_subject_prefix(sidecar, self.prefix)
+                with timer.measure("decode"):
+                    image = tagger.decoder.open(item.path)
+                    if image is not None:
+                        image.load()
+                if image is None:
+                    continue
+                with timer.measure("transform"):
+                    tensor = tagger.prepare_image(image)
+                image.close()
+                batch.append(tensor)
+                if len(batch) == tagger.a_batch_size:
+                    with timer.measure("inference", len(batch)):
+                        tagger.get_tags_for_tensors(batch)
+                    batch = []
+            if len(batch) > 0:
+                with timer.measure("inference", len(batch)):
+                    tagger.get_tags_for_tensors(batch)
+
+            for item in items:
+                for sidecar in item.sidecars:
+                    with timer.measure("xmp_parse"):
+                        handler = XMPHandler(sidecar)
+                    with timer.measure("xmp_write"):
+                        for tag in ["benchmark", "tree", "sky"]:
+                            handler.add_hierarchical_subject(self.prefix + "|" + tag)
+                        SidecarWriter.write_atomic(sidecar, handler.serialize(), handler.original)
+        return timer.results()
+
+    def run_enter_dir(self, library):
+        tagged = [0]
+        write_result = self.tagger.write_result
+
+        def count(result):
+            if result[2]:
+                tagged[0] += 1
+            write_result(result)
+
+        index = TagIndex(TagIndex.default_path(library))
+        writer = SidecarWriter()
+        self.tagger.configure_run(False, False, False, self.prefix, index, writer)
+        self.tagger.write_result = count
+        files = sum(1 for _ in DirectoryScanner.scan(library))
+        start = time.perf_counter()
+        try:
+            with self.output():
+                self.tagger.enter_dir(library, threading.Event())
+                writer.close()
+        finally:
+            del self.tagger.write_result
+            index.close()
+        seconds = time.perf_counter() - start
+        return {"files": files, "tagged": tagged[0], "seconds": round(seconds, 4),
+                "files_per_s": round(files / seconds, 2) if seconds > 0 else None,
+                "tagged_per_s": round(tagged[0] / seconds, 2) if seconds > 0 else None}
+
+    def run(self):
+        results = {"stages": self.run_stages()}
+        library = self.copy_library("enter_dir")
+        results["enter_dir"] = self.run_enter_dir(library)
+        # everything is tagged and in the index now, this measures what a re-run costs
+        results["enter_dir_rerun"] = self.run_enter_dir(library)
+        return results
+
+
+def environment(tagger, args):
+    return {"python": platform.python_version(), "torch": torch.__version__, "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "device": str(tagger.device), "torch_threads": torch.get_num_threads(),
+            "model": "stub" if args.stub_model else "ram_plus", "precision": args.precision,
+            "batch_size": args.batch_size, "decode_workers": args.decode_workers, "workers": args.workers}
+
+
+def parse_sizes(value):
+    try:
+        return [tuple(int(v) for v in size.lower().split("x")) for size in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("sizes look like 640x480,1920x1280")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='STAG benchmark')
+
+    parser.add_argument('--library',
+                        metavar='DIR',
+                        help='where to generate the synthetic library, kept for later runs (default=temporary directory)')
+
+    parser.add_argument('--images',
+                        metavar='N',
+                        type=int,
+                        help='number of images in the library (default=120)',
+                        default=120)
+
+    parser.add_argument('--sizes',
+                        metavar='WxH,...',
+                        type=parse_sizes,
+                        help='image sizes (default=640x480,1920x1280,4000x3000)',
+                        default=[(640, 480), (1920, 1280), (4000, 3000)])
+
+    parser.add_argument('--formats',
+                        metavar='F,...',
+                        help='image formats, out of jpeg, png, tiff and heic (default=all)',
+                        default='jpeg,png,tiff,heic')
+
+    parser.add_argument('--seed',
+                        metavar='N',
+                        type=int,
+                        help='seed for the library (default=0)',
+                        default=0)
+
+    parser.add_argument('--stub-model',
+                        action='store_true',
+                        help="use a tiny stand-in model instead of RAM++, to benchmark everything else without downloading it")
+
+    parser.add_argument('--batch-size',
+                        metavar='N',
+                        type=int,
+                        help='number of images to run through the model at once (default=8)',
+                        default=8)
+
+    parser.add_argument('--decode-workers',
+                        metavar='N',
+                        type=int,
+                        help='number of threads decoding images while the model is busy (default=2)',
+                        default=2)
+
+    parser.add_argument('--workers',
+                        metavar='N',
+                        type=int,
+                        help='number of tagging processes, CPU only (default=1)',
+                        default=1)
+
+    parser.add_argument('--precision',
+                        choices=InferenceMode.PRECISIONS,
+                        help='precision to run the model in (default=fp32)',
+                        default='fp32')
+
+    parser.add_argument('--output',
+                        metavar='FILE',
+                        help='write the results as JSON to FILE instead of stdout')
+
+    parser.add_argument('--verbose',
+                        action='store_true',
+                        help="show the tagger's output")
+
+    args = parser.parse_args()
+    formats = [f.strip().lower() for f in args.formats.split(",") if f.strip() != ""]
+    unknown = [f for f in formats if f not in SyntheticLibrary.FORMATS]
+    if len(unknown) > 0:
+        parser.error("unknown formats: " + ", ".join(unknown))
+
+    work_dir = tempfile.mkdtemp(prefix="stag_benchmark_")
+    try:
+        library = SyntheticLibrary(args.library or os.path.join(work_dir, "library"), args.images, args.sizes, formats,
+                                   args.seed)
+        manifest = library.generate()
+
+        pretrained = None if args.stub_model else ModelStore.checkpoint_path()
+        tagger = SKTagger(pretrained, 384, False, False, False, "st", args.batch_size, args.decode_workers,
+                          a_workers=args.workers, a_inference_mode=InferenceMode(args.precision))
+        if args.stub_model:
+            # never load the real model
+            tagger._model = StubModel().eval().to(tagger.device)
+        tagger.load_model()
+
+        results = {"environment": environment(tagger, args), "library": manifest}
+        results.update(Benchmark(tagger, library.root, work_dir, verbose=args.verbose).run())
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+        print("Results written to ", args.output)
+    else:
+        json.dump(results, sys.stdout, indent=1)
+        print()
@@ -0,0 +1,364 @@
+
+#############################################
+## Tagging service                          #
+## keeps the model loaded between runs      #
+#############################################
+
+import hmac
+import itertools
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tagindex import TagIndex
+from progress import Progress
+
+DEFAULT_PORT = 8734
+
+# only readable by the user, a request has to send its content to be accepted
+TOKEN_PATH = os.path.join(os.path.expanduser("~"), ".stag", "service_token")
+TOKEN_HEADER = "X-STAG-Token"
+
+
+def _write_token(path):
+    # a new token for every start of the service
+    token = secrets.token_hex(32)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    os.replace(tmp_path, path)
+    return token
+
+
+def _read_token(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class Job:
+    """
+    A directory or a list of files to tag, with the settings to tag them with.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, path=None, files=None, prefix="st", force=False, test=False,
+                 prefer_exact_filenames=False, index=True):
+        if (path is None) == (files is None):
+            raise ValueError("a job needs either a path or a list of files")
+        if path is not None and not os.path.isdir(path):
+            raise ValueError("not a directory: " + str(path))
+        self.id = next(Job._ids)
+        self.path = path
+        self.files = files
+        self.prefix = prefix or "st"
+        self.force = bool(force)
+        self.test = bool(test)
+        self.prefer_exact_filenames = bool(prefer_exact_filenames)
+        self.index = bool(index)
+        self.state = "queued"
+        self.error = None
+        self.stop_event = threading.Event()
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.progress = None
+
+    @staticmethod
+    def from_dict(d):
+        return Job(d.get("path"), d.get("files"), d.get("prefix", "st"), d.get("force", False),
+                   d.get("test", False), d.get("prefer_exact_filenames", False), d.get("index", True))
+
+    def to_dict(self):
+        return {"id": self.id, "path": self.path, "files": None if self.files is None else len(self.files),
+                "prefix": self.prefix, "force": self.force, "test": self.test,
+                "prefer_exact_filenames": self.prefer_exact_filenames, "index": self.index,
+                "state": self.state, "error": self.error,
+                "submitted": self.submitted, "started": self.started, "finished": self.finished,
+                "progress": None if self.progress is None else self.progress.snapshot()}
+
+
+class TaggingDaemon:
+    """
+    Keeps one tagger with a loaded model around and runs the jobs sent to it one after the other.
+    Jobs are submitted, queried and cancelled through a small JSON API on localhost:
+
+    - POST /jobs with {"path": DIR} or {"files": [FILE, ...]} and optional "prefix", "force",
+      "test", "prefer_exact_filenames" and "index" queues a job and returns it
+    - GET /jobs lists all jobs, GET /jobs/<id> returns one
+    - DELETE /jobs/<id> cancels a job, whether it is queued or already running
+    - GET /status returns the job currently running and the number of queued jobs
+
+    Every request has to send the token from token_path (only readable by the user) in the
+    X-STAG-Token header, and POSTs have to be application/json. Requests with an Origin header come
+    from a web browser and are refused, so web pages can't send jobs to the service.
+    """
+
+    def __init__(self, tagger, writer=None, port=DEFAULT_PORT, token_path=TOKEN_PATH):
+        self.tagger = tagger
+        self.writer = writer
+        self.port = port
+        self.token_path = token_path
+        self.token = None
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.current = None
+        self.stopping = threading.Event()
+
+    def submit(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        print("Queued job %d" % job.id)
+        return job
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job.state == "queued":
+                job.state = "cancelled"
+                job.finished = time.time()
+        job.stop_event.set()
+        return job
+
+    def status(self):
+        with self.lock:
+            return {"running": None if self.current is None else self.current.to_dict(),
+                    "queued": sum(1 for job in self.jobs.values() if job.state == "queued")}
+
+    def serve_forever(self):
+        self.token = _write_token(self.token_path)
+        runner = threading.Thread(target=self._run_jobs, daemon=True)
+        runner.start()
+        server = ThreadingHTTPServer(("127.0.0.1", self.port), _RequestHandler)
+        server.daemon_threads = True
+        server.tagging_daemon = self
+        print("STAG waiting for jobs on http://127.0.0.1:%d" % self.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Shutting down...")
+        finally:
+            server.server_close()
+            self.stopping.set()
+            with self.lock:
+                for job in self.jobs.values():
+                    job.stop_event.set()
+            runner.join()
+
+    def _run_jobs(self):
+        while not self.stopping.is_set():
+            try:
+                job = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self.lock:
+                if job.state != "queued":
+                    continue
+                # same output settings as the service, but counted per job
+                settings = self.tagger.progress
+                job.progress = Progress(settings.verbose, settings.events, settings.summary_interval)
+                job.state = "running"
+                job.started = time.time()
+                self.current = job
+            try:
+                self._run(job)
+                state = "cancelled" if job.stop_event.is_set() else "done"
+            except Exception as e:
+                print("Job %d failed: %s" % (job.id, str(e)))
+                job.error = str(e)
+                state = "failed"
+            with self.lock:
+                job.state = state
+                job.finished = time.time()
+                self.current = None
+            print("Job %d %s" % (job.id, state))
+
+    def _run(self, job):
+        index = None
+        if job.index and job.path is not None:
+            index = TagIndex(TagIndex.default_path(job.path))
+        try:
+            self.tagger.configure_run(job.force, job.test, job.prefer_exact_filenames, job.prefix, index, self.writer,
+                                      job.progress)
+            if job.path is not None:
+                self.tagger.enter_dir(job.path, job.stop_event)
+            else:
+                self.tagger.tag_files(job.files, job.stop_event)
+        finally:
+            if index is not None:
+                index.close()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        # clients poll, logging every request would drown the tagger output
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _allowed(self):
+        # sends an error and returns False if the request may not use the service
+        if self.headers.get("Origin") is not None:
+            self._send(403, {"error": "requests from web pages are not accepted"})
+            return False
+        token = self.headers.get(TOKEN_HEADER, "")
+        if not hmac.compare_digest(token.encode("utf-8"), self.server.tagging_daemon.token.encode("utf-8")):
+            self._send(401, {"error": "missing or wrong token"})
+            return False
+        return True
+
+    def _job_id(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            return int(parts[1])
+        return None
+
+    def do_GET(self):
+        if not self._allowed():
+            return
+        daemon = self.server.tagging_daemon
+        if self.path == "/status":
+            self._send(200, daemon.status())
+        elif self.path == "/jobs":
+            with daemon.lock:
+                body = [job.to_dict() for job in daemon.jobs.values()]
+            self._send(200, body)
+        elif self._job_id() is not None:
+            with daemon.lock:
+                job = daemon.jobs.get(self._job_id())
+                body = None if job is None else job.to_dict()
+            if body is None:
+                self._send(404, {"error": "no such job"})
+            else:
+                self._send(200, body)
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if not self._allowed():
+            return
+        # anything else could be sent by a web page without a CORS preflight
+        if self.headers.get("Content-Type", "").split(";")[0].strip().lower() != "application/json":
+            self._send(415, {"error": "Content-Type has to be application/json"})
+            return
+        if self.path != "/jobs":
+            self._send(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = Job.from_dict(json.loads(self.rfile.read(length).decode("utf-8")))
+        except Exception as e:
+            self._send(400, {"error": str(e)})
+            return
+        self._send(200, self.server.tagging_daemon.submit(job).to_dict())
+
+    def do_DELETE(self):
+        if not self._allowed():
+            return
+        job = None
+        if self._job_id() is not None:
+            job = self.server.tagging_daemon.cancel(self._job_id())
+        if job is None:
+            self._send(404, {"error": "no such job"})
+        else:
+            self._send(200, job.to_dict())
+
+
+class DaemonClient:
+    """
+    Talks to a running TaggingDaemon, for the CLI and the GUI to tag without loading the model themselves.
+    """
+
+    def __init__(self, port=DEFAULT_PORT, timeout=10, token_path=TOKEN_PATH):
+        self.url = "http://127.0.0.1:%d" % port
+        self.timeout = timeout
+        self.token_path = token_path
+
+    def _request(self, method, path, body=None):
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        # read every time, the service writes a new one when it is restarted
+        request = urllib.request.Request(self.url + path, data=data, method=method,
+                                         headers={"Content-Type": "application/json",
+                                                  TOKEN_HEADER: _read_token(self.token_path) or ""})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(json.loads(e.read().decode("utf-8")).get("error", str(e)))
+
+    def is_running(self):
+        try:
+            self._request("GET", "/status")
+            return True
+        except Exception:
+            return False
+
+    def status(self):
+        return self._request("GET", "/status")
+
+    def submit(self, **job):
+        return self._request("POST", "/jobs", job)
+
+    def job(self, job_id):
+        return self._request("GET", "/jobs/%d" % job_id)
+
+    def cancel(self, job_id):
+        return self._request("DELETE", "/jobs/%d" % job_id)
+
+    def run(self, stop_event=None, poll_interval=0.5, summary_interval=10, on_progress=None, **job):
+        """
+        Submits a job and waits until it is finished, printing a summary of its progress every
+        summary_interval seconds. on_progress(snapshot) is called whenever the job was polled.
+        Setting stop_event (or Ctrl-C) cancels it. Returns the finished job.
+        """
+        current = self.submit(**job)
+        print("Submitted job %d to the STAG service" % current["id"])
+        state = current["state"]
+        last_summary = time.time()
+        try:
+            while state not in ["done", "cancelled", "failed"]:
+                if stop_event is not None and stop_event.is_set():
+                    self.cancel(current["id"])
+                time.sleep(poll_interval)
+                current = self.job(current["id"])
+                if current["progress"] is not None and on_progress is not None:
+                    on_progress(current["progress"])
+                if current["progress"] is not None and time.time() - last_summary >= summary_interval:
+                    print(Progress.summary_of(current["progress"]))
+                    last_summary = time.time()
+                if current["state"] != state:
+                    state = current["state"]
+                    if current["progress"] is not None and state != "running":
+                        print(Progress.summary_of(current["progress"]))
+                    print("Job %d %s" % (current["id"], state))
+        except KeyboardInterrupt:
+            self.cancel(current["id"])
+            print("Job %d cancelled" % current["id"])
+            raise
+        if current["error"] is not None:
+            print("Job failed: ", current["error"])
+        return current
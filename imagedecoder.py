@@ -0,0 +1,121 @@
+
+import io
+
+import rawpy
+from PIL import ExifTags, Image, ImageOps
+from pillow_heif import register_heif_opener
+
+
+class ImageDecoder:
+    """
+    Opens image files for tagging. As the model only looks at a small version of each image,
+    files are decoded at the smallest resolution that's still at least min_size: JPEGs are
+    DCT-scaled while decoding, tiled TIFFs use their pyramid levels and RAW files don't have
+    to be fully demosaiced – the embedded preview or a half size decode is usually more than enough.
+
+    Images returned by open() should be closed by the caller.
+    """
+
+    IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".tiff", ".tif", ".png", ".heic"]
+
+    # preview: embedded JPEG preview if it's at least min_size, otherwise half size
+    # half:    half size decode without demosaicing
+    # full:    full demosaic, slow
+    RAW_STRATEGIES = ["preview", "half", "full"]
+
+    # libraw's flip values and how to undo them
+    RAW_FLIPS = {
+        3: Image.Transpose.ROTATE_180,
+        5: Image.Transpose.ROTATE_90,
+        6: Image.Transpose.ROTATE_270
+    }
+
+    def __init__(self, min_size=384, raw_strategy="preview"):
+        if raw_strategy not in ImageDecoder.RAW_STRATEGIES:
+            raise ValueError("unknown RAW decode strategy " + str(raw_strategy))
+        self.min_size = min_size
+        self.raw_strategy = raw_strategy
+        # libheif can't decode HEIC files at a reduced size, but at least it doesn't
+        # have to decode thumbnails, depth maps and auxiliary images we never look at
+        register_heif_opener(thumbnails=False, depth_images=False, aux_images=False)
+
+    @staticmethod
+    def is_image_file(filename):
+        return filename.lower().endswith(tuple(ImageDecoder.IMAGE_EXTENSIONS))
+
+    def open(self, image_file):
+        # returns a PIL image or None if the file can't be read
+        if ImageDecoder.is_image_file(image_file):
+            try:
+                return self.reduce(Image.open(image_file))
+            except Exception as e:
+                print("could not read", image_file, e)
+                return None
+        # not one of the known file types? Could be a raw file.
+        try:
+            return self.open_raw(image_file)
+        except Exception as e:
+            print("Could not read ", image_file, " because of ", str(e))
+            return None
+
+    def reduce(self, image):
+        # select the smallest version of a freshly opened image that's still big enough, before it's decoded
+        if image.format == "TIFF":
+            self.select_pyramid_level(image)
+        else:
+            # only does something for JPEGs
+            image.draft(None, (self.min_size, self.min_size))
+        return image
+
+    def select_pyramid_level(self, image):
+        best_frame = 0
+        best_width = image.size[0]
+        for frame in range(1, getattr(image, "n_frames", 1)):
+            image.seek(frame)
+            # NewSubfileType bit 0 marks reduced resolution versions of the first page
+            if image.tag_v2.get(254, 0) & 1 == 0:
+                continue
+            if min(image.size) >= self.min_size and image.size[0] < best_width:
+                best_frame = frame
+                best_width = image.size[0]
+        image.seek(best_frame)
+
+    def open_raw(self, image_file):
+        with rawpy.imread(image_file) as raw:
+            if self.raw_strategy == "preview":
+                image = self.raw_preview(raw)
+                if image is not None:
+                    return image
+            if self.raw_strategy in ["preview", "half"]:
+                try:
+                    return Image.fromarray(raw.postprocess(half_size=True))
+                except rawpy.LibRawError as e:
+                    print("Half size decode of ", image_file, " failed, falling back to full decode: ", str(e))
+            return Image.fromarray(raw.postprocess())
+
+    def raw_preview(self, raw):
+        # the embedded preview, or None if there is none or it's too small to be useful
+        try:
+            thumb = raw.extract_thumb()
+        except rawpy.LibRawError:
+            return None
+        if thumb.format == rawpy.ThumbFormat.JPEG:
+            image = self.reduce(Image.open(io.BytesIO(thumb.data)))
+        elif thumb.format == rawpy.ThumbFormat.BITMAP:
+            image = Image.fromarray(thumb.data)
+        else:
+            return None
+        if min(image.size) < self.min_size:
+            image.close()
+            return None
+
+        # previews with EXIF orientation are rotated by that, all others by the orientation of the raw
+        if image.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+            rotated = ImageOps.exif_transpose(image)
+        else:
+            flip = ImageDecoder.RAW_FLIPS.get(raw.sizes.flip)
+            if flip is None:
+                return image
+            rotated = image.transpose(flip)
+        image.close()
+        return rotated
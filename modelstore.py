@@ -0,0 +1,106 @@
+
+import contextlib
+import os
+import tempfile
+
+import torch
+
+import huggingface_hub
+from huggingface_hub import hf_hub_download, try_to_load_from_cache
+from ram.models import ram_plus
+
+
+@contextlib.contextmanager
+def _skip_init():
+    # the random initialization of the weights is wasted work when they are replaced right after
+    names = ["uniform_", "normal_", "trunc_normal_", "constant_", "ones_", "zeros_",
+             "xavier_uniform_", "xavier_normal_", "kaiming_uniform_", "kaiming_normal_"]
+    saved = {name: getattr(torch.nn.init, name) for name in names if hasattr(torch.nn.init, name)}
+    for name in saved:
+        setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        for name, function in saved.items():
+            setattr(torch.nn.init, name, function)
+
+
+class ModelStore:
+    """
+    Finds the RAM++ checkpoint and loads the model from it.
+
+    The checkpoint from the hub has to be read completely and post-processed on every start.
+    After the first load the ready-to-use weights are saved once in a format torch can
+    memory-map, later starts map that file instead: the weights are paged in as they are
+    needed and stay in the page cache, where several processes can share them.
+    """
+
+    REPO_ID = "xinyu1205/recognize-anything-plus-model"
+    FILE_NAME = "ram_plus_swin_large_14m.pth"
+    VIT = "swin_l"
+
+    @staticmethod
+    def cached_checkpoint():
+        # path of the checkpoint if it was already downloaded, None otherwise. Never touches the network
+        path = try_to_load_from_cache(ModelStore.REPO_ID, ModelStore.FILE_NAME)
+        return path if isinstance(path, str) and os.path.isfile(path) else None
+
+    @staticmethod
+    def checkpoint_path():
+        # only asks the hub if the checkpoint isn't cached yet
+        path = ModelStore.cached_checkpoint()
+        if path is None:
+            path = hf_hub_download(repo_id=ModelStore.REPO_ID, filename=ModelStore.FILE_NAME)
+        return path
+
+    @staticmethod
+    def cache_dir():
+        # where STAG keeps what it derives from the checkpoint and its own measurements
+        return os.path.join(huggingface_hub.constants.HF_HOME, "stag")
+
+    @staticmethod
+    def artifact_path(checkpoint_path, image_size):
+        # the name of the blob in the hub cache is the hash of the checkpoint, so a new checkpoint gets a new file
+        key = os.path.basename(os.path.realpath(checkpoint_path))
+        return os.path.join(ModelStore.cache_dir(), "ram_plus_%s_%d_%s.pt" % (ModelStore.VIT, image_size, key))
+
+    @staticmethod
+    def load_model(checkpoint_path, image_size):
+        artifact = ModelStore.artifact_path(checkpoint_path, image_size)
+        if os.path.isfile(artifact):
+            try:
+                return ModelStore.load_mapped(artifact, image_size)
+            except Exception as e:
+                print("Could not map ", artifact, ", loading the checkpoint instead: ", str(e))
+        model = ram_plus(pretrained=checkpoint_path, image_size=image_size, vit=ModelStore.VIT)
+        try:
+            ModelStore.save_artifact(model, artifact)
+        except Exception as e:
+            print("Could not save ", artifact, ": ", str(e))
+        return model
+
+    @staticmethod
+    def load_mapped(artifact, image_size):
+        state_dict = torch.load(artifact, map_location="cpu", weights_only=True, mmap=True)
+        with _skip_init():
+            model = ram_plus(pretrained="", image_size=image_size, vit=ModelStore.VIT)
+        # assign keeps the mapped tensors instead of copying them into the new parameters
+        model.load_state_dict(state_dict, assign=True)
+        return model
+
+    @staticmethod
+    def save_artifact(model, artifact):
+        directory = os.path.dirname(artifact)
+        os.makedirs(directory, exist_ok=True)
+        print("Saving the model for faster startup to ", artifact)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                torch.save(model.state_dict(), f)
+            os.replace(tmp_path, artifact)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
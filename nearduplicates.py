@@ -0,0 +1,53 @@
+
+#############################################
+## Reusing tags for near-duplicate frames   #
+#############################################
+
+import os
+from collections import deque
+
+import torch
+
+
+class NearDuplicateFilter:
+    """
+    Remembers the perceptual hashes of the last window images that were run through the model,
+    so nearly identical frames of a burst or a bracketed sequence can get their tags instead of
+    being tagged again. Only images in the same directory are compared.
+
+    The hash is a 64 bit difference hash of the resized image: it is averaged down to 9x8
+    gray pixels and every bit tells whether a pixel is brighter than its left neighbour.
+    Two images are near duplicates if their hashes differ in at most max_distance bits.
+    """
+
+    def __init__(self, window=8, max_distance=5):
+        self.max_distance = max_distance
+        # (hash, path, tags, outputs) of recently tagged images, newest last
+        self.recent = deque(maxlen=max(1, window))
+
+    @staticmethod
+    def hashes(tensors):
+        # one hash per resized image (H x W x 3 uint8 tensors, from BatchPreprocessor.prepare)
+        gray = torch.stack(tensors).float().mean(dim=3).unsqueeze(1)
+        pixels = torch.nn.functional.adaptive_avg_pool2d(gray, (8, 9))[:, 0]
+        bits = (pixels[:, :, 1:] > pixels[:, :, :-1]).flatten(1).tolist()
+        return [sum(1 << i for i, bit in enumerate(row) if bit) for row in bits]
+
+    @staticmethod
+    def distance(a, b):
+        return bin(a ^ b).count("1")
+
+    def is_similar(self, path, image_hash, other_path, other_hash):
+        return os.path.dirname(path) == os.path.dirname(other_path) and \
+            NearDuplicateFilter.distance(image_hash, other_hash) <= self.max_distance
+
+    def find(self, path, image_hash):
+        # (path, tags, outputs) of the most recent similar image, or None
+        for recent_hash, recent_path, tags, outputs in reversed(self.recent):
+            if self.is_similar(path, image_hash, recent_path, recent_hash):
+                return recent_path, tags, outputs
+        return None
+
+    def add(self, path, image_hash, tags, outputs=None):
+        # outputs: the scores of the model for the image, if they are kept
+        self.recent.append((image_hash, path, tags, outputs))
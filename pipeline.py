@@ -0,0 +1,136 @@
+
+#############################################
+## Staged tagging pipeline                  #
+## decode -> inference -> write             #
+#############################################
+
+import queue
+import threading
+
+# marks the end of a stream in a queue
+_DONE = object()
+
+
+class TaggingPipeline:
+    """
+    Runs the three stages of tagging concurrently, connected by bounded queues:
+
+    - a pool of decode workers, turning work items into model input (decode(item) -> decoded or None)
+    - the inference stage in the calling thread, working on batches (infer([decoded, ...]) -> [result, ...])
+    - a single writer thread (write(result))
+
+    The queues are bounded, so no more than a few batches are held in memory at any time.
+    Setting stop_event makes the decode and inference stages stop as soon as possible,
+    results which were already computed are still handed to the writer.
+    """
+
+    def __init__(self, decode, infer, write, stop_event,
+                 decode_workers=2, batch_size=8, poll_interval=0.1):
+        self.decode = decode
+        self.infer = infer
+        self.write = write
+        self.stop_event = stop_event
+        # set when the inference stage ends with an exception, the other stages have to stop, too
+        self.aborted = threading.Event()
+        self.decode_workers = max(1, decode_workers)
+        self.batch_size = max(1, batch_size)
+        self.poll_interval = poll_interval
+
+        self.work_queue = queue.Queue(maxsize=2 * self.decode_workers)
+        self.decoded_queue = queue.Queue(maxsize=2 * self.batch_size)
+        self.write_queue = queue.Queue(maxsize=2 * self.batch_size)
+
+    def run(self, items):
+        threads = [threading.Thread(target=self._produce, args=(items,), daemon=True)]
+        for _ in range(self.decode_workers):
+            threads.append(threading.Thread(target=self._decode_loop, daemon=True))
+        writer = threading.Thread(target=self._write_loop, daemon=True)
+
+        for t in threads:
+            t.start()
+        writer.start()
+
+        try:
+            self._infer_loop()
+        except BaseException:
+            # like Ctrl-C in the main thread, the decode stage must not keep waiting for it
+            self.aborted.set()
+            raise
+        finally:
+            # the writer always drains its queue, so completed tags are never lost
+            self.write_queue.put(_DONE)
+            writer.join()
+            for t in threads:
+                t.join()
+
+    def _put(self, q, item):
+        # put that gives up once the pipeline is cancelled, so no stage blocks forever
+        while not self._stopped():
+            try:
+                q.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _stopped(self):
+        return self.stop_event.is_set() or self.aborted.is_set()
+
+    def _produce(self, items):
+        try:
+            for item in items:
+                if self._stopped() or not self._put(self.work_queue, item):
+                    return
+        except Exception as e:
+            print("Listing files failed: ", str(e))
+        for _ in range(self.decode_workers):
+            if not self._put(self.work_queue, _DONE):
+                return
+
+    def _decode_loop(self):
+        while not self._stopped():
+            try:
+                item = self.work_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                self._put(self.decoded_queue, _DONE)
+                return
+            try:
+                decoded = self.decode(item)
+            except Exception as e:
+                print("Could not process ", item, " because of ", str(e))
+                decoded = None
+            if decoded is not None:
+                self._put(self.decoded_queue, decoded)
+
+    def _infer_loop(self):
+        running_decoders = self.decode_workers
+        batch = []
+        while running_decoders > 0 and not self.stop_event.is_set():
+            try:
+                decoded = self.decoded_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            if decoded is _DONE:
+                running_decoders -= 1
+            else:
+                batch.append(decoded)
+            if len(batch) >= self.batch_size or (running_decoders == 0 and len(batch) > 0):
+                self._flush(batch)
+                batch = []
+
+    def _flush(self, batch):
+        for result in self.infer(batch):
+            if result is not None:
+                self.write_queue.put(result)
+
+    def _write_loop(self):
+        while True:
+            result = self.write_queue.get()
+            if result is _DONE:
+                return
+            try:
+                self.write(result)
+            except Exception as e:
+                print("Writing tags failed: ", str(e))
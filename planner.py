@@ -0,0 +1,84 @@
+
+#############################################
+## Planning a run before loading the model  #
+#############################################
+
+import json
+import os
+from collections import Counter
+
+from progress import Progress
+
+
+class TaggingPlan:
+    """
+    What a run is going to do: the images that need tagging, counted by format, and how many were
+    skipped. Images of a capture group are counted, but only need one inference together.
+    """
+
+    def __init__(self):
+        self.items = []
+        # extension -> number of images to tag
+        self.formats = Counter()
+        self.skipped = 0
+
+    def add(self, item):
+        self.items.append(item)
+        for i in [item] + item.members:
+            self.formats[os.path.splitext(i.path)[1].lstrip(".").upper() or "no extension"] += 1
+
+    def skip(self, item):
+        self.skipped += 1 + len(item.members)
+
+    def is_empty(self):
+        return len(self.items) == 0
+
+    def inferences(self):
+        return len(self.items)
+
+    def files(self):
+        return sum(self.formats.values())
+
+    def describe(self, images_per_s=None):
+        if self.is_empty():
+            return "Nothing to tag, %d files are already tagged." % self.skipped
+        formats = ", ".join("%d %s" % (n, ext) for ext, n in self.formats.most_common())
+        text = "%d of %d files to tag (%s) in %d inferences, %d already tagged." % (
+            self.files(), self.files() + self.skipped, formats, self.inferences(), self.skipped)
+        if images_per_s:
+            text += " Estimated time: %s at %.2f images/s." % (
+                Progress.format_duration(self.inferences() / images_per_s), images_per_s)
+        else:
+            text += " No time estimate until STAG has tagged images with these settings once."
+        return text
+
+
+class Throughput:
+    """
+    Remembers how many images per second the last run with the same settings tagged on this machine,
+    for estimating how long the next one is going to take.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, key):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f).get(key)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key, images_per_s):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                rates = json.load(f)
+        except (OSError, ValueError):
+            rates = {}
+        rates[key] = round(images_per_s, 3)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(rates, f, indent=1)
+        except OSError as e:
+            print("Could not save ", self.path, ": ", str(e))
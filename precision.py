@@ -0,0 +1,123 @@
+
+import contextlib
+import time
+
+import torch
+
+from scanner import DirectoryScanner
+
+
+class InferenceMode:
+    """
+    How the model is run: in full fp32 precision, with bf16 autocast or with the linear layers of the
+    swin_l backbone dynamically quantized to int8. Optionally with channels_last memory layout and
+    torch.compile. The reduced precision modes are meant for machines without a GPU.
+    """
+
+    PRECISIONS = ["fp32", "bf16", "int8"]
+
+    def __init__(self, precision="fp32", channels_last=False, compile=False):
+        if precision not in InferenceMode.PRECISIONS:
+            raise ValueError("unknown precision " + str(precision))
+        self.precision = precision
+        self.channels_last = channels_last
+        self.compile = compile
+
+    def __str__(self):
+        extras = [name for name, on in [("channels_last", self.channels_last), ("compile", self.compile)] if on]
+        return "+".join([self.precision] + extras)
+
+    def prepare_model(self, model, device, image_size=384):
+        # returns the model to use, some of the changes can't be undone
+        if self.precision == "int8":
+            if device.type != "cpu":
+                print("int8 quantization is only supported on CPU, using fp32")
+                self.precision = "fp32"
+            else:
+                model.visual_encoder = torch.ao.quantization.quantize_dynamic(
+                    model.visual_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        if self.compile:
+            if hasattr(torch, "compile"):
+                eager = model.visual_encoder
+                try:
+                    model.visual_encoder = torch.compile(eager)
+                    # compiling only happens on the first call, so that's where it fails
+                    batch = self.prepare_batch(torch.zeros((1, 3, image_size, image_size), device=device))
+                    with torch.no_grad(), self.context(device):
+                        model.visual_encoder(batch)
+                except Exception as e:
+                    print("torch.compile not available, running without: ", str(e))
+                    model.visual_encoder = eager
+                    self.compile = False
+            else:
+                print("torch.compile needs PyTorch 2.0 or newer, running without")
+                self.compile = False
+        return model
+
+    def prepare_batch(self, batch):
+        if self.channels_last:
+            return batch.contiguous(memory_format=torch.channels_last)
+        return batch
+
+    def context(self, device):
+        if self.precision == "bf16":
+            return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    @staticmethod
+    def tag_set(tags):
+        return set(item.strip() for item in tags.split("|") if item.strip() != "")
+
+    def check_against_fp32(self, tagger, img_dir, samples=50):
+        """
+        Tags up to samples images from img_dir with tagger (which has to be running in fp32) and again
+        after switching it to this mode, and prints how much the tags differ. Nothing is written.
+        Leaves the tagger running in this mode.
+        """
+        decoded = []
+        for item in DirectoryScanner.scan(img_dir):
+            if len(decoded) >= samples:
+                break
+            result = tagger.decode_image(item)
+            if result is not None:
+                decoded.append(result)
+        if len(decoded) == 0:
+            print("No images found in ", img_dir)
+            return None
+        tensors = [tensor for _, _, tensor in decoded]
+
+        start = time.time()
+        reference = tagger.get_tags_for_tensors(tensors)
+        reference_time = time.time() - start
+
+        tagger.set_inference_mode(self)
+        # the first batch includes warmup (and compilation), so it's not timed
+        tagger.get_tags_for_tensors(tensors[:tagger.a_batch_size])
+        start = time.time()
+        candidate = tagger.get_tags_for_tensors(tensors)
+        candidate_time = time.time() - start
+
+        similarities = []
+        missing = 0
+        added = 0
+        for (image_file, _, _), ref, cand in zip(decoded, reference, candidate):
+            ref = InferenceMode.tag_set(ref)
+            cand = InferenceMode.tag_set(cand)
+            union = ref | cand
+            similarities.append(len(ref & cand) / len(union) if len(union) > 0 else 1.0)
+            missing += len(ref - cand)
+            added += len(cand - ref)
+            if ref != cand:
+                print("%s: missing %s, added %s" % (image_file, sorted(ref - cand), sorted(cand - ref)))
+
+        mean_similarity = sum(similarities) / len(similarities)
+        identical = sum(1 for s in similarities if s == 1.0)
+        print("Compared %s against fp32 on %d images:" % (self, len(decoded)))
+        print("  identical tag sets: %d of %d" % (identical, len(decoded)))
+        print("  mean Jaccard similarity: %.3f" % mean_similarity)
+        print("  tags missing: %d, tags added: %d" % (missing, added))
+        print("  fp32: %.2f images/s, %s: %.2f images/s" % (len(decoded) / reference_time, self,
+                                                            len(decoded) / candidate_time))
+        return mean_similarity
@@ -0,0 +1,232 @@
+
+#############################################
+## Progress events and metrics              #
+#############################################
+
+import bisect
+import json
+import os
+import threading
+import time
+
+
+class LatencyHistogram:
+    """
+    Counts durations in buckets growing roughly by factors of 2 and 2.5, from 1ms to 10s.
+    Cheap enough to be updated for every file.
+    """
+
+    # upper bounds of the buckets in ms, the last bucket has no upper bound
+    BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+    def __init__(self):
+        self.buckets = [0] * (len(LatencyHistogram.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds, count=1):
+        # count items processed together in seconds, like a batch, each get their share
+        per_item = seconds / count
+        self.buckets[bisect.bisect_left(LatencyHistogram.BOUNDS_MS, per_item * 1000)] += count
+        self.count += count
+        self.total += seconds
+        self.max = max(self.max, per_item)
+
+    def percentile(self, p):
+        # upper bound of the bucket the p-th percentile falls into, in ms
+        if self.count == 0:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(LatencyHistogram.BOUNDS_MS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return round(self.max * 1000, 1)
+
+    def to_dict(self):
+        return {"count": self.count, "total_s": round(self.total, 3),
+                "mean_ms": round(1000 * self.total / self.count, 2) if self.count > 0 else None,
+                "p50_ms": self.percentile(50), "p95_ms": self.percentile(95),
+                "max_ms": round(1000 * self.max, 1),
+                "buckets_ms": {label: n for label, n in zip(LatencyHistogram.labels(), self.buckets) if n > 0}}
+
+    @staticmethod
+    def labels():
+        return ["<=%d" % b for b in LatencyHistogram.BOUNDS_MS] + [">%d" % LatencyHistogram.BOUNDS_MS[-1]]
+
+
+class Progress:
+    """
+    Collects what happens during a run: counters for files found, skipped, tagged and failed,
+    latency histograms for every stage and the depth of the pipeline queues.
+
+    Per-file output goes to stdout unless verbose is False, errors are printed in any case.
+    If events is a file object, every file also gets a JSON line there. With summary_interval,
+    a summary with images/s and ETA is printed every summary_interval seconds.
+    """
+
+    def __init__(self, verbose=True, events=None, summary_interval=None):
+        self.verbose = verbose
+        self.events = events
+        self.summary_interval = summary_interval
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.stopped = threading.Event()
+        self.reporter = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # write_failed counts files that were tagged, but their sidecars couldn't be written
+            # reused counts files that got the tags of another file instead of being run through the model
+            self.counters = {"found": 0, "skipped": 0, "tagged": 0, "failed": 0, "write_failed": 0, "reused": 0}
+            self.stages = {}
+            self.scan_complete = False
+            self.total = None
+            self.started = time.time()
+            self.finished = None
+
+    def start(self, total=None):
+        # total: number of files to look at, if known up front
+        self.reset()
+        self.total = total
+        self._event("started", total=total)
+        if self.summary_interval:
+            self.stopped.clear()
+            self.reporter = threading.Thread(target=self._report, daemon=True)
+            self.reporter.start()
+
+    def finish(self):
+        if self.reporter is not None:
+            self.stopped.set()
+            self.reporter.join()
+            self.reporter = None
+        self.queues = {}
+        self.finished = time.time()
+        self._event("finished", **self.counts())
+        print(self.summary())
+
+    def watch_queue(self, name, q):
+        self.queues[name] = q
+
+    def counting(self, items):
+        # passes items through, counting them as found
+        for item in items:
+            with self.lock:
+                self.counters["found"] += 1
+            yield item
+        with self.lock:
+            self.scan_complete = True
+        self._event("scan_complete", found=self.counters["found"])
+
+    def skipped(self, path, reason):
+        self._count("skipped")
+        if self.verbose:
+            print("File %s %s." % (os.path.basename(path), reason))
+        self._event("skipped", path=path, reason=reason)
+
+    def tagged(self, path, tags):
+        self._count("tagged")
+        if self.verbose:
+            print('Looking at %s:' % path)
+            print("Tags found: ", tags)
+        self._event("tagged", path=path, tags=tags)
+
+    def reused(self, path, source, reason):
+        self._count("reused")
+        if self.verbose:
+            print("File %s gets the tags of %s (%s)" % (os.path.basename(path), os.path.basename(source), reason))
+        self._event("reused", path=path, source=source, reason=reason)
+
+    def failed(self, path, stage, error=None):
+        # error None: the reason was already printed
+        self._count("write_failed" if stage == "write" else "failed")
+        if error is not None:
+            print("Could not %s %s: %s" % (stage, path, str(error)))
+        self._event("failed", path=path, stage=stage, error=None if error is None else str(error))
+
+    def message(self, text):
+        if self.verbose:
+            print(text)
+
+    def stage_time(self, stage, seconds, count=1):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = LatencyHistogram()
+            histogram.add(seconds, count)
+
+    def counts(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            stages = {name: histogram.to_dict() for name, histogram in self.stages.items()}
+            scan_complete = self.scan_complete
+            total = self.total
+        elapsed = (self.finished or time.time()) - self.started
+        done = counters["skipped"] + counters["tagged"] + counters["failed"]
+        if total is None and scan_complete:
+            total = counters["found"]
+        rate = counters["tagged"] / elapsed if elapsed > 0 else 0.0
+        files_rate = done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if total is not None and files_rate > 0:
+            eta = max(0, total - done) / files_rate
+        queues = {}
+        for name, q in list(self.queues.items()):
+            try:
+                queues[name] = q.qsize()
+            except NotImplementedError:
+                pass
+        return {"counters": counters, "done": done, "total": total, "elapsed_s": round(elapsed, 1),
+                "images_per_s": round(rate, 2), "files_per_s": round(files_rate, 2),
+                "eta_s": None if eta is None else round(eta, 1), "queues": queues, "stages": stages}
+
+    def summary(self):
+        return Progress.summary_of(self.snapshot())
+
+    @staticmethod
+    def summary_of(s):
+        # one line for a snapshot(), which may come from another process
+        c = s["counters"]
+        text = "%d tagged, %d skipped, %d failed" % (c["tagged"], c["skipped"], c["failed"])
+        if c.get("reused", 0) > 0:
+            text += ", %d inferences saved" % c["reused"]
+        if s["total"] is not None:
+            text += " of %d files" % s["total"]
+        text += " in %s, %.2f images/s" % (Progress.format_duration(s["elapsed_s"]), s["images_per_s"])
+        if s["eta_s"] is not None and s["done"] < (s["total"] or 0):
+            text += ", ETA %s" % Progress.format_duration(s["eta_s"])
+        return text
+
+    @staticmethod
+    def format_duration(seconds):
+        seconds = int(seconds)
+        if seconds >= 3600:
+            return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+        return "%d:%02d" % (seconds // 60, seconds % 60)
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _event(self, event, **fields):
+        if self.events is None:
+            return
+        fields["event"] = event
+        fields["time"] = round(time.time(), 3)
+        line = json.dumps(fields)
+        with self.lock:
+            self.events.write(line + "\n")
+            self.events.flush()
+
+    def _report(self):
+        while not self.stopped.wait(self.summary_interval):
+            snapshot = self.snapshot()
+            print(Progress.summary_of(snapshot))
+            self._event("summary", **{k: v for k, v in snapshot.items() if k != "stages"})
@@ -0,0 +1,158 @@
+
+import os
+
+from xmphandler import XMPHandler
+
+
+class ScanItem:
+    """
+    An image found by the scanner, together with its XMP sidecars and the directory
+    entries they were found with, so their stat results don't have to be fetched twice.
+
+    members are the other images of the same capture group (like the RAW file next to a JPEG),
+    which get the tags found for this one.
+    """
+
+    __slots__ = ["path", "sidecars", "entries", "members"]
+
+    def __init__(self, path, sidecars, entries=None, members=None):
+        self.path = path
+        self.sidecars = sidecars
+        # absolute path -> os.DirEntry
+        self.entries = entries or {}
+        self.members = members or []
+
+    @staticmethod
+    def for_file(image_file):
+        # for single files outside of a scan: probes the file system for sidecars
+        return ScanItem(image_file, XMPHandler.get_xmp_sidecars_for_image(image_file))
+
+    def file_state(self, path):
+        # (size, mtime in ns) of the image or one of its sidecars, or None if it doesn't exist
+        entry = self.entries.get(os.path.abspath(path))
+        try:
+            st = entry.stat() if entry is not None else os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def without_entries(self):
+        # a copy that can be sent to another process
+        return ScanItem(self.path, self.sidecars, None, [member.without_entries() for member in self.members])
+
+    def __repr__(self):
+        return self.path
+
+
+class DirectoryScanner:
+    """
+    Walks a directory tree and pairs images with their XMP sidecars. Every directory is listed
+    exactly once and the pairing is done in memory, without probing for possible sidecar names.
+    The ".xmp" extension of sidecars is matched case-insensitively.
+
+    Images in the same directory with the same name except for the extension form a capture group,
+    like IMG_0001.JPG and IMG_0001.CR2. Only the one cheapest to decode has to be tagged.
+    """
+
+    # lower is cheaper to decode at the size the model needs, everything else is treated as RAW
+    DECODE_COST = {".jpg": 0, ".jpeg": 0, ".heic": 1, ".png": 2, ".tif": 3, ".tiff": 3}
+    RAW_COST = 4
+
+    # only these are grouped, .MOV, .AAE and the like next to an image stay on their own
+    RAW_EXTENSIONS = {".3fr", ".arw", ".cr2", ".cr3", ".crw", ".dcr", ".dng", ".erf", ".iiq", ".k25", ".kdc",
+                      ".mef", ".mos", ".mrw", ".nef", ".nrw", ".orf", ".pef", ".raf", ".raw", ".rw2", ".rwl",
+                      ".sr2", ".srf", ".srw", ".x3f"}
+
+    @staticmethod
+    def is_hidden(name):
+        # nothing but trouble with hidden files, so skip those
+        return name.startswith(".")
+
+    @staticmethod
+    def decode_cost(path):
+        return DirectoryScanner.DECODE_COST.get(os.path.splitext(path)[1].lower(), DirectoryScanner.RAW_COST)
+
+    @staticmethod
+    def is_capture(path):
+        extension = os.path.splitext(path)[1].lower()
+        return extension in DirectoryScanner.DECODE_COST or extension in DirectoryScanner.RAW_EXTENSIONS
+
+    @staticmethod
+    def group_captures(items):
+        """
+        Merges the items of each capture group into one, for the member cheapest to decode,
+        with the others as its members. Keeps the order of the first member of each group.
+        """
+        groups = {}
+        for item in items:
+            if DirectoryScanner.is_capture(item.path):
+                key = (os.path.splitext(item.path)[0], True)
+            else:
+                # a group of its own
+                key = (item.path, False)
+            groups.setdefault(key, []).append(item)
+        grouped = []
+        for group in groups.values():
+            group = sorted(group, key=lambda i: (DirectoryScanner.decode_cost(i.path), i.path))
+            group[0].members = group[1:]
+            grouped.append(group[0])
+        return grouped
+
+    @staticmethod
+    def scan(img_dir, group_captures=True):
+        # yields ScanItems, directory by directory, sorted by name within each directory
+        pending = [img_dir]
+        while len(pending) > 0:
+            current_dir = pending.pop()
+            try:
+                with os.scandir(current_dir) as it:
+                    entries = list(it)
+            except OSError as e:
+                print("Could not read directory ", current_dir, " because of ", str(e))
+                continue
+            subdirs = []
+            files = []
+            for entry in entries:
+                try:
+                    # like os.walk: links to directories are directories, but aren't followed
+                    is_dir = entry.is_dir()
+                    is_link = entry.is_symlink()
+                except OSError:
+                    is_dir = False
+                    is_link = False
+                if is_dir:
+                    # like .stag_scores
+                    if not DirectoryScanner.is_hidden(entry.name) and not is_link:
+                        subdirs.append(entry.path)
+                else:
+                    files.append(entry)
+            items = DirectoryScanner.pair_sidecars(current_dir, files)
+            if group_captures:
+                items = DirectoryScanner.group_captures(items)
+            yield from items
+            # walk subdirectories in order, top-down like os.walk
+            pending.extend(sorted(subdirs, reverse=True))
+
+    @staticmethod
+    def pair_sidecars(current_dir, files):
+        # sidecar base name ("IMG_0001" or "IMG_0001.CR2") -> sidecar entries
+        sidecars = {}
+        images = []
+        for entry in files:
+            if DirectoryScanner.is_hidden(entry.name):
+                continue
+            if XMPHandler.is_xmp_file(entry.name):
+                sidecars.setdefault(entry.name[:-4], []).append(entry)
+            else:
+                images.append(entry)
+
+        for entry in sorted(images, key=lambda e: e.name):
+            base, _ = os.path.splitext(entry.name)
+            found = []
+            # same order as XMPHandler.possible_names_for_image
+            for candidate in [entry.name, base] if base != entry.name else [base]:
+                found.extend(sorted(sidecars.get(candidate, []), key=lambda e: e.name))
+            item_entries = {}
+            for e in [entry] + found:
+                item_entries[os.path.abspath(e.path)] = e
+            yield ScanItem(entry.path, [sidecar.path for sidecar in found], item_entries)
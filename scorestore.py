@@ -0,0 +1,203 @@
+
+#############################################
+## Stored model outputs                     #
+## tags can be recomputed without the model #
+#############################################
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+import numpy as np
+import torch
+
+
+class ModelOutputs:
+    """
+    Collects the per-class scores, and optionally the image embeddings, that RAM++ computes while
+    tagging a batch, using forward hooks on its classification head and its image projection.
+    """
+
+    def __init__(self, model, embeddings=False):
+        self.model = model
+        self.embeddings = embeddings
+        self.scores = None
+        self.embedding = None
+        self.handles = []
+
+    def __enter__(self):
+        self.handles.append(self.model.fc.register_forward_hook(self._store_scores))
+        if self.embeddings:
+            self.handles.append(self.model.image_proj.register_forward_hook(self._store_embedding))
+        return self
+
+    def __exit__(self, *args):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def _store_scores(self, module, inputs, output):
+        # the same probabilities generate_tag compares with the class thresholds
+        self.scores = torch.sigmoid(output.float()).reshape(output.shape[0], -1).cpu().numpy().astype(np.float16)
+
+    def _store_embedding(self, module, inputs, output):
+        # RAM++ projects every image token, the first one describes the whole image
+        if output.dim() == 3:
+            output = output[:, 0, :]
+        self.embedding = output.float().cpu().numpy().astype(np.float16)
+
+    def rows(self):
+        # (scores, embedding or None) for every image of the batch
+        return [(self.scores[i], None if self.embedding is None else self.embedding[i])
+                for i in range(self.scores.shape[0])]
+
+
+class ScoreStore:
+    """
+    Keeps the scores the model gave every class for every image, so tags can be computed again with
+    other thresholds, another vocabulary or another prefix without running the model. Scores (and
+    embeddings) are float16 rows of memory mapped .npy files, an SQLite table maps the path, size and
+    mtime of each image to its row. Rows of images that changed since are not used.
+    """
+
+    DIR_NAME = ".stag_scores"
+
+    # the arrays grow by at least this many rows at a time
+    GROW_ROWS = 1024
+
+    # commit after this many changes, committing every single one is slow
+    COMMIT_INTERVAL = 100
+
+    @staticmethod
+    def default_path(img_dir):
+        return os.path.join(img_dir, ScoreStore.DIR_NAME)
+
+    @staticmethod
+    def vocabulary_of(model):
+        # what generate_tag needs to turn scores into tags
+        return {"tags": [str(t) for t in model.tag_list],
+                "thresholds": [float(t) for t in torch.as_tensor(model.class_threshold).flatten().tolist()],
+                "deleted": [int(i) for i in getattr(model, "delete_tag_index", [])]}
+
+    def __init__(self, store_path, embeddings=False):
+        self.path = store_path
+        self.embeddings = embeddings
+        self.lock = threading.Lock()
+        self.pending = 0
+        os.makedirs(store_path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(store_path, "files.sqlite"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                row INTEGER NOT NULL,
+                has_embedding INTEGER NOT NULL
+            )""")
+        self.db.commit()
+        self.rows = self.db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM files").fetchone()[0]
+        self.vocabulary = None
+        if os.path.exists(self._file("vocabulary.json")):
+            with open(self._file("vocabulary.json"), encoding="utf-8") as f:
+                self.vocabulary = json.load(f)
+        self.arrays = {name: self._open(name) for name in ["scores", "embeddings"]}
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _open(self, name):
+        if not os.path.exists(self._file(name + ".npy")):
+            return None
+        return np.load(self._file(name + ".npy"), mmap_mode="r+")
+
+    def _ensure_rows(self, name, rows, width):
+        # grows the array name to hold at least rows rows, by copying it to a larger file
+        array = self.arrays[name]
+        if array is not None and array.shape[1] != width:
+            raise ValueError("%s in %s have %d columns, not %d" % (name, self.path, array.shape[1], width))
+        if array is not None and array.shape[0] >= rows:
+            return array
+        capacity = max(rows, ScoreStore.GROW_ROWS, 0 if array is None else 2 * array.shape[0])
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=self.path)
+        os.close(fd)
+        grown = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float16, shape=(capacity, width))
+        if array is not None:
+            grown[:array.shape[0]] = array
+            del array
+            self.arrays[name] = None
+        grown.flush()
+        del grown
+        os.replace(tmp, self._file(name + ".npy"))
+        self.arrays[name] = self._open(name)
+        return self.arrays[name]
+
+    def set_vocabulary(self, vocabulary):
+        if self.vocabulary is not None:
+            if len(self.vocabulary["tags"]) != len(vocabulary["tags"]):
+                raise ValueError("the scores in %s are from a model with %d classes, not %d" %
+                                 (self.path, len(self.vocabulary["tags"]), len(vocabulary["tags"])))
+            return
+        with open(self._file("vocabulary.json"), "w", encoding="utf-8") as f:
+            json.dump(vocabulary, f)
+        self.vocabulary = vocabulary
+
+    def put(self, image_file, file_state, scores, embedding=None):
+        if file_state is None:
+            return
+        image_file = os.path.abspath(image_file)
+        with self.lock:
+            row = self.db.execute("SELECT row FROM files WHERE path = ?", (image_file,)).fetchone()
+            if row is None:
+                row = self.rows
+                self.rows += 1
+            else:
+                row = row[0]
+            self._ensure_rows("scores", row + 1, len(scores))[row] = scores
+            has_embedding = self.embeddings and embedding is not None
+            if has_embedding:
+                self._ensure_rows("embeddings", row + 1, len(embedding))[row] = embedding
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                            (image_file, file_state[0], file_state[1], row, int(has_embedding)))
+            self.pending += 1
+            if self.pending >= ScoreStore.COMMIT_INTERVAL:
+                self.db.commit()
+                self.pending = 0
+
+    def get(self, image_file, file_state):
+        # (scores, embedding or None) of the image, None if there are none or the image changed since
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, row, has_embedding FROM files WHERE path = ?",
+                                  (os.path.abspath(image_file),)).fetchone()
+            if row is None or file_state != (row[0], row[1]) or self.arrays["scores"] is None:
+                return None
+            embedding = self.arrays["embeddings"][row[2]] if row[3] and self.arrays["embeddings"] is not None else None
+            return np.array(self.arrays["scores"][row[2]]), None if embedding is None else np.array(embedding)
+
+    def tags_for(self, scores, threshold=None, allowed=None):
+        """
+        The tags for scores, like generate_tag would have found them. threshold replaces the
+        thresholds of the model for all classes, allowed is a set of the only tags to keep.
+        """
+        tags = self.vocabulary["tags"]
+        if threshold is None:
+            thresholds = np.array(self.vocabulary["thresholds"], dtype=np.float32)
+        else:
+            thresholds = np.full(len(tags), threshold, dtype=np.float32)
+        selected = scores.astype(np.float32) > thresholds
+        selected[self.vocabulary["deleted"]] = False
+        return [tags[i] for i in np.flatnonzero(selected) if allowed is None or tags[i] in allowed]
+
+    def commit(self):
+        with self.lock:
+            for array in self.arrays.values():
+                if array is not None:
+                    array.flush()
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
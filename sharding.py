@@ -0,0 +1,165 @@
+
+#############################################
+## Tagging one tree on several machines     #
+#############################################
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+
+def _relative_key(root, path):
+    # the same on every machine, wherever the tree is mounted
+    return os.path.relpath(os.path.abspath(path), os.path.abspath(root)).replace(os.sep, "/")
+
+
+class Shard:
+    """
+    Shard index of count (1 <= index <= count): a stable part of the images below root, chosen by a
+    hash of their path relative to root. Every machine tagging the same tree with the same count gets
+    the same partition, no matter where the tree is mounted.
+    """
+
+    def __init__(self, index, count, root):
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError("shard %d/%d: the shard has to be between 1 and %d" % (index, count, count))
+        self.index = index
+        self.count = count
+        self.root = root
+
+    @staticmethod
+    def parse(text, root):
+        # "i/N"
+        index, _, count = text.partition("/")
+        return Shard(int(index), int(count), root)
+
+    def contains(self, path):
+        digest = hashlib.sha1(_relative_key(self.root, path).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") % self.count == self.index - 1
+
+    def select(self, scan, steal=False):
+        """
+        Yields the items of this shard from scan(), a function returning ScanItems.
+        With steal, the items of all other shards follow, for the files other machines didn't get to.
+        """
+        for item in scan():
+            if self.contains(item.path):
+                yield item
+        if steal:
+            for item in scan():
+                if not self.contains(item.path):
+                    yield item
+
+    def __repr__(self):
+        return "%d/%d" % (self.index, self.count)
+
+
+class ClaimDirectory:
+    """
+    Lets several machines tag the same tree on a shared file system without tagging an image twice.
+    Before an image is tagged, a claim file named after the hash of its relative path is created in
+    claims_dir with O_EXCL, so only one machine gets it. The claim is deleted once the sidecars are
+    written. Claims are touched every stale_after / 4 seconds while they are held, so the claims of a
+    machine that crashed can be taken over once they weren't touched for stale_after seconds.
+    The clocks of the machines must not differ by more than a fraction of stale_after.
+    """
+
+    DIR_NAME = ".stag_claims"
+
+    def __init__(self, root, claims_dir, stale_after=600.0):
+        self.root = root
+        self.path = claims_dir
+        self.stale_after = stale_after
+        self.node = "%s-%d" % (socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        # claim file -> image path
+        self.held = {}
+        os.makedirs(claims_dir, exist_ok=True)
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._touch_held, daemon=True)
+        self.heartbeat.start()
+
+    @staticmethod
+    def default_path(img_dir):
+        return os.path.join(img_dir, ClaimDirectory.DIR_NAME)
+
+    def claim_file(self, path):
+        key = _relative_key(self.root, path)
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".claim")
+
+    def claim(self, path):
+        # True if this machine may tag path now, False if another one is working on it
+        claim_file = self.claim_file(path)
+        for _ in range(3):
+            try:
+                fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+            except FileExistsError:
+                try:
+                    if not self._is_stale(claim_file):
+                        return False
+                except FileNotFoundError:
+                    # released in the meantime
+                    continue
+                print("Taking over the stale claim of", path)
+                self._reclaim(claim_file)
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"node": self.node, "path": _relative_key(self.root, path), "time": time.time()}, f)
+            with self.lock:
+                self.held[claim_file] = path
+            return True
+        return False
+
+    def release(self, path):
+        claim_file = self.claim_file(path)
+        with self.lock:
+            if self.held.pop(claim_file, None) is None:
+                return
+        try:
+            os.remove(claim_file)
+        except OSError:
+            pass
+
+    def release_all(self):
+        with self.lock:
+            paths = list(self.held.values())
+        for path in paths:
+            self.release(path)
+
+    def close(self):
+        self.stopped.set()
+        self.heartbeat.join()
+        self.release_all()
+
+    def _is_stale(self, claim_file):
+        return time.time() - os.stat(claim_file).st_mtime > self.stale_after
+
+    def _reclaim(self, claim_file):
+        # moves the stale claim out of the way, only one of the machines trying this at once succeeds
+        moved = "%s.%s.stale" % (claim_file, self.node)
+        try:
+            os.rename(claim_file, moved)
+        except OSError:
+            return
+        try:
+            if not self._is_stale(moved):
+                # another machine took it over just before, give its fresh claim back
+                try:
+                    os.link(moved, claim_file)
+                except OSError:
+                    pass
+        finally:
+            os.remove(moved)
+
+    def _touch_held(self):
+        while not self.stopped.wait(self.stale_after / 4):
+            with self.lock:
+                claim_files = list(self.held)
+            for claim_file in claim_files:
+                try:
+                    os.utime(claim_file)
+                except OSError as e:
+                    print("Could not refresh claim", claim_file, "because of", str(e))
@@ -0,0 +1,152 @@
+
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+def _get_umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# new files get the same permissions as if they were created with open()
+_UMASK = _get_umask()
+
+
+class SidecarWriter:
+    """
+    Writes sidecar files on a small pool of background threads, so slow (network) file systems
+    don't hold up tagging. Files are written to a temporary file, synced and renamed over the
+    original, so an interrupted run never leaves a truncated XMP file behind. Content that
+    didn't change is not written at all.
+
+    Writes to the same file are done in the order they were submitted. Call wait_for() before
+    reading a file that might still have a write pending, and flush() before exiting.
+    """
+
+    def __init__(self, max_workers=4, max_pending=64, verbose=True):
+        self.verbose = verbose
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="sidecar-writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        # path -> future of the last job writing it
+        self.pending = {}
+        # sidecars that didn't exist before
+        self.created = set()
+
+    @staticmethod
+    def write_atomic(path, content, original=None):
+        """
+        Writes content to path via a temporary file in the same directory.
+        original is what the file contained when it was read (None: read it now).
+        Returns False if the file already had the same content and wasn't written.
+        """
+        data = content.encode("utf-8")
+        if original is None:
+            try:
+                with open(path, "rb") as f:
+                    original = f.read()
+            except OSError:
+                pass
+        if data == original:
+            return False
+
+        directory, name = os.path.split(os.path.abspath(path))
+        # hidden, so it's skipped by the tagger if it's ever left behind
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix="." + name + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(path):
+                shutil.copymode(path, tmp_path)
+            else:
+                os.chmod(tmp_path, 0o666 & ~_UMASK)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        return True
+
+    def submit(self, files, on_done=None):
+        """
+        Writes files, a list of (path, content, original content) tuples, in the background.
+        on_done() is called after all of them were written successfully.
+        Blocks while too many writes are pending.
+        """
+        paths = [path for path, _, _ in files]
+        self.slots.acquire()
+        with self.lock:
+            self.created.update(path for path, _, original in files if original is None)
+            earlier = [self.pending[path] for path in paths if path in self.pending]
+            future = self.executor.submit(self._write, files, earlier, on_done)
+            for path in paths:
+                self.pending[path] = future
+        future.add_done_callback(lambda f: self._finished(f, paths))
+        return future
+
+    def _write(self, files, earlier, on_done):
+        # jobs run in submission order, so earlier writes to the same files are already running or done
+        wait(earlier)
+        success = True
+        for path, content, original in files:
+            try:
+                if SidecarWriter.write_atomic(path, content, original) and self.verbose:
+                    print("writing to ", path)
+            except Exception as e:
+                print("Writing ", path, " failed: ", str(e))
+                success = False
+        if success and on_done is not None:
+            on_done()
+
+    def _finished(self, future, paths):
+        with self.lock:
+            for path in paths:
+                if self.pending.get(path) is future:
+                    del self.pending[path]
+        self.slots.release()
+
+    def has_created(self, path):
+        # True if path is a new sidecar submitted to this writer
+        with self.lock:
+            return path in self.created
+
+    def wait_for(self, paths):
+        # waits until all writes to the given files are on disk
+        with self.lock:
+            futures = [self.pending[path] for path in paths if path in self.pending]
+        wait(futures)
+
+    def when_written(self, paths, callback):
+        # calls callback() once all writes to the given files submitted so far are done
+        with self.lock:
+            futures = [self.pending[path] for path in paths if path in self.pending]
+        if len(futures) == 0:
+            callback()
+            return
+        remaining = [len(futures)]
+
+        def done(_):
+            with self.lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                callback()
+        for future in futures:
+            future.add_done_callback(done)
+
+    def flush(self):
+        # waits until everything submitted so far is written
+        with self.lock:
+            futures = list(self.pending.values())
+        wait(futures)
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
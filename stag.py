@@ -6,110 +6,533 @@
 #############################################
 
 import argparse
+import sys
 import threading
+import time
 
-import rawpy
 import torch
 
-from huggingface_hub import hf_hub_download
-from PIL import Image
-from ram import get_transform
-from ram import inference_ram as inference
-from ram.models import ram_plus
 from xmphandler import *
-from pillow_heif import register_heif_opener
+from imagedecoder import ImageDecoder
+from tagindex import TagIndex
+from sidecarwriter import SidecarWriter
+from scanner import DirectoryScanner, ScanItem
+from pipeline import TaggingPipeline
+from workers import ProcessTagger
+from precision import InferenceMode
+from modelstore import ModelStore
+from daemon import TaggingDaemon, DaemonClient, DEFAULT_PORT
+from progress import Progress
+from preprocess import BatchPreprocessor
+from planner import TaggingPlan, Throughput
+from nearduplicates import NearDuplicateFilter
+from scorestore import ModelOutputs, ScoreStore
+from sharding import ClaimDirectory, Shard
+from watcher import DirectoryWatcher
 
 
 class SKTagger:
 
     def __init__(self, model_path, image_size,
-                 a_force, a_test, a_prefer_exact, a_prefix ):
-        register_heif_opener()
-        self.transform = get_transform(image_size=image_size)
+                 a_force, a_test, a_prefer_exact, a_prefix, a_batch_size=8, a_decode_workers=2, a_raw_decode="preview",
+                 a_index=None, a_writer=None, a_workers=1, a_threads_per_worker=None, a_inference_mode=None,
+                 a_progress=None, a_capture_groups=True, a_near_duplicates=None, a_score_store=None,
+                 a_shard=None, a_claims=None):
+        self.decoder = ImageDecoder(image_size, a_raw_decode)
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print("STAG using device ", self.device)
-        self.model = ram_plus(pretrained=model_path, image_size=image_size, vit='swin_l')
-        self.model.eval()
-        self.model = self.model.to(self.device)
+        self.preprocessor = BatchPreprocessor(image_size, self.device, a_batch_size)
+        self.model_path = model_path
+        self.image_size = image_size
+        # loaded on first use, so a run without anything to tag doesn't wait for it
+        self._model = None
+        self.model_lock = threading.Lock()
+        self.inference_mode = InferenceMode()
+        if a_inference_mode is not None:
+            self.set_inference_mode(a_inference_mode)
         self.a_force = a_force
         self.a_test = a_test
         self.a_prefer_exact = a_prefer_exact
         self.a_prefix = a_prefix
+        self.a_batch_size = max(1, a_batch_size)
+        self.a_decode_workers = max(1, a_decode_workers)
+        self.index = a_index
+        self.writer = a_writer
+        self.a_workers = max(1, a_workers)
+        self.a_threads_per_worker = a_threads_per_worker
+        self.progress = a_progress or Progress()
+        self.a_capture_groups = a_capture_groups
+        # image path -> members of its capture group, until the tags are written
+        self.capture_groups = {}
+        # a NearDuplicateFilter, to reuse the tags of similar frames
+        self.near_duplicates = a_near_duplicates
+        # a ScoreStore, to keep the scores of every class for retagging without the model
+        self.score_store = a_score_store
+        # a Shard, to only tag part of the tree, and a ClaimDirectory, to share the work with other machines
+        self.shard = a_shard
+        self.claims = a_claims
+        self.throughput = Throughput(os.path.join(ModelStore.cache_dir(), "throughput.json"))
 
+    @property
+    def model(self):
+        return self.load_model()
+
+    def load_model(self):
+        with self.model_lock:
+            if self._model is None:
+                if self.model_path is None:
+                    # not downloaded yet, that's only done once there is something to tag
+                    self.model_path = ModelStore.checkpoint_path()
+                model = ModelStore.load_model(self.model_path, self.image_size)
+                model.eval()
+                model = model.to(self.device)
+                self._model = self.inference_mode.prepare_model(model, self.device, self.image_size)
+            return self._model
 
     def get_tags_for_image(self, pil_image):
+        return self.get_tags_for_images([pil_image], batch_size=1)[0]
+
+    def get_tags_for_images(self, pil_images, batch_size=None):
+        # returns one tag string per image, in order. Images which could not be tagged get ""
+        return self.get_tags_for_tensors([self.prepare_image(image) for image in pil_images], batch_size)
+
+    def prepare_image(self, pil_image):
         try:
-            torch_image = self.transform(pil_image).unsqueeze(0).to(self.device)
-            res=inference(torch_image, self.model)
-            return res[0]
+            return self.preprocessor.prepare(pil_image)
         except Exception as e:
-            print ("Tagging failed: ",str(e))
-            return ""
+            print("Tagging failed: ", str(e))
+            return None
+
+    def get_tags_for_tensors(self, tensors, batch_size=None):
+        # same as get_tags_for_images, for images already run through prepare_image. None entries get ""
+        return ["" if tags is None else tags for tags in self.run_batches(tensors, batch_size)]
+
+    def run_batches(self, tensors, batch_size=None, outputs=None):
+        # like get_tags_for_tensors, but images which could not be tagged get None.
+        # outputs: a list as long as tensors, gets the (scores, embedding) of every image tagged
+        if batch_size is None:
+            batch_size = self.a_batch_size
+        # outside of the retries below, a failed load is not a problem of the images
+        self.load_model()
+        results = [None] * len(tensors)
+        for start in range(0, len(tensors), batch_size):
+            indices = [i for i in range(start, min(start + batch_size, len(tensors))) if tensors[i] is not None]
+            if len(indices) == 0:
+                continue
+            try:
+                batch = self.preprocessor.batch([tensors[i] for i in indices])
+                rows = None if outputs is None else []
+                for n, (i, tags) in enumerate(zip(indices, self.run_model(batch, rows))):
+                    results[i] = tags
+                    if outputs is not None:
+                        outputs[i] = rows[n]
+            except Exception as e:
+                # don't let one bad image spoil the whole batch, retry them one by one
+                print("Batch tagging failed, retrying images one by one: ", str(e))
+                for i in indices:
+                    try:
+                        rows = None if outputs is None else []
+                        results[i] = self.run_model(self.preprocessor.batch([tensors[i]]), rows)[0]
+                        if outputs is not None:
+                            outputs[i] = rows[0]
+                    except Exception as e:
+                        print("Tagging failed: ", str(e))
+        return results
+
+    def set_inference_mode(self, mode):
+        print("STAG running the model in", mode)
+        with self.model_lock:
+            if self._model is not None:
+                self._model = mode.prepare_model(self._model, self.device, self.image_size)
+            self.inference_mode = mode
+
+    def run_model(self, batch, outputs=None):
+        # outputs: a list that gets the (scores, embedding) of every image appended
+        batch = self.inference_mode.prepare_batch(batch.to(self.device))
+        with torch.no_grad(), self.inference_mode.context(self.device):
+            if outputs is None:
+                tags, _ = self.model.generate_tag(batch)
+            else:
+                with ModelOutputs(self.model, self.score_store.embeddings) as captured:
+                    tags, _ = self.model.generate_tag(batch)
+                outputs.extend(captured.rows())
+        return tags
 
     def get_tags_for_image_at_path(self, path):
-        pillow_image = Image.open(path)
-        return self.get_tags_for_image(pillow_image)
+        pillow_image = self.decoder.open(path)
+        if pillow_image is None:
+            return ""
+        try:
+            return self.get_tags_for_image(pillow_image)
+        finally:
+            pillow_image.close()
+
+    def configure_run(self, a_force, a_test, a_prefer_exact, a_prefix, a_index=None, a_writer=None, a_progress=None):
+        # changes the settings of the next run, so one loaded model can be used for many runs
+        self.a_force = a_force
+        self.a_test = a_test
+        self.a_prefer_exact = a_prefer_exact
+        self.a_prefix = a_prefix
+        self.index = a_index
+        self.writer = a_writer
+        if a_progress is not None:
+            self.progress = a_progress
 
     def enter_dir(self, img_dir, stop_event):
         print("Entering " + img_dir)
-        for current_dir, subdirList, fileList in os.walk(img_dir):
-            for fname in sorted(fileList):
+        self.tag_items(self.scan_dir(img_dir), stop_event)
 
-                if stop_event.is_set():
-                    print("Tagging cancelled.")
-                    return
+    def plan_dir(self, img_dir):
+        # dry run: reports what enter_dir would do, without loading the model
+        print("Planning " + img_dir)
+        plan = self.make_plan(self.scan_dir(img_dir))
+        print(plan.describe(self.throughput.load(self.throughput_key())))
+        return plan
 
-                if fname.startswith("."):
-                    # nothing but trouble with hidden files, so skip those
-                    continue
+    def scan_dir(self, img_dir):
+        items = DirectoryScanner.scan(img_dir, self.a_capture_groups)
+        if self.shard is not None:
+            # with claims, the files of the other shards are tagged afterwards, if nobody else did
+            print("Tagging shard %s%s" % (self.shard, ", then the others" if self.claims is not None else ""))
+            items = self.shard.select(lambda: DirectoryScanner.scan(img_dir, self.a_capture_groups),
+                                      steal=self.claims is not None)
+        return items
 
-                image_file = os.path.join(current_dir, fname)
-                image = None
-                filename, file_extension = os.path.splitext(image_file)
-                file_extension = file_extension.lower()
-                sidecar_files = XMPHandler.get_xmp_sidecars_for_image(image_file)
-
-                # determine if we already have tagged this image
-                already_tagged = False
-                if not self.a_force:
-                    for current_file in sidecar_files:
-                        handler= XMPHandler(current_file)
-                        already_tagged |= handler.has_subject_prefix(self.a_prefix)
-
-                if not already_tagged:
-                    if file_extension in [".jpg", ".jpeg", ".tiff", ".tif", ".png", ".heic"]:
-                        try:
-                            image = Image.open(image_file)
-                        except Exception as e:
-                            print ("could not read", image_file, e)
-                    elif file_extension != ".xmp":
-                        # not one of the known file types and not xmp? Could be a raw file.
-                        try:
-                            with rawpy.imread(image_file) as raw:
-                                rgb = raw.postprocess()
-                                image = Image.fromarray(rgb)
-                        except Exception as e:
-                            print("Could not read ", image_file, " because of ", str(e))
-
-                    if image is not None:
-                        print('Looking at %s:' % image_file)
-                        res = [item.strip() for item in self.get_tags_for_image(image).split("|")]
-                        print("Tags found: ", res)
-                        if res != "":
-                            if len(sidecar_files) == 0:
-                                if self.a_test is not True:
-                                    sidecar_files = [XMPHandler.create_xmp_sidecar(image_file, self.a_prefer_exact)]
-                                else:
-                                    print("skipping XMP file creation, not writing tags")
-                            for current_file in sidecar_files:
-                                handler = XMPHandler(current_file)
-                                for t in res:
-                                    handler.add_hierarchical_subject(self.a_prefix+"|"+t)
-                                if self.a_test is not True:
-                                    handler.save()
+    def make_plan(self, items, stop_event=None):
+        plan = TaggingPlan()
+        for item in items:
+            if stop_event is not None and stop_event.is_set():
+                print("Tagging cancelled.")
+                break
+            if not DirectoryScanner.is_capture(item.path):
+                # would fail to decode on every run, and keep the plan from ever being empty
+                self.progress.skipped(item.path, "not an image")
+                continue
+            start = time.perf_counter()
+            try:
+                if self.is_group_tagged(item):
+                    self.progress.skipped(item.path, "already tagged")
+                    plan.skip(item)
                 else:
-                    if file_extension != ".xmp":
-                        print("File %s already tagged." % fname)
+                    plan.add(item)
+            except Exception as e:
+                self.progress.failed(item.path, "check", e)
+            self.progress.stage_time("check", time.perf_counter() - start)
+        return plan
+
+    def throughput_key(self):
+        return "%s %s, %d workers, batch size %d" % (self.device.type, self.inference_mode, self.a_workers,
+                                                     self.a_batch_size)
+
+    def watch_dir(self, img_dir, stop_event, poll_interval=None, settle_time=2.0):
+        # tags what's already there, then new and changed images as they appear, until stop_event is set
+        watcher = DirectoryWatcher(img_dir, poll_interval, settle_time)
+        self.enter_dir(img_dir, stop_event)
+        print("Watching %s for new images (%s)" % (img_dir, watcher.method()))
+        for items in watcher.batches(stop_event):
+            print("%d new or changed files in %s" % (len(items), img_dir))
+            if self.a_capture_groups:
+                items = DirectoryScanner.group_captures(items)
+            if self.shard is not None and self.claims is None:
+                items = [item for item in items if self.shard.contains(item.path)]
+            self.tag_items(items, stop_event)
+
+    def tag_files(self, image_files, stop_event):
+        self.tag_items((ScanItem.for_file(image_file) for image_file in image_files), stop_event)
+
+    def tag_items(self, items, stop_event):
+        self.progress.start()
+        # everything is checked before the model is loaded, a run with nothing to tag never loads it
+        plan = self.make_plan(self.progress.counting(items), stop_event)
+        if stop_event.is_set():
+            self.progress.finish()
+            return
+        print(plan.describe(self.throughput.load(self.throughput_key())))
+        if plan.is_empty():
+            self.progress.finish()
+            return
+        # once, here: a model that can't be loaded must not be retried for every batch and image
+        try:
+            self.load_model()
+        except Exception as e:
+            self.progress.finish()
+            raise RuntimeError("Could not load the model: " + str(e)) from e
+        items = plan.items
+        start = time.perf_counter()
+        if self.a_workers > 1 and ProcessTagger.is_supported(self.device):
+            ProcessTagger(self, self.a_workers, self.a_threads_per_worker).run(items, stop_event)
+        else:
+            if self.a_workers > 1:
+                print("Worker processes are only supported on CPU and on systems with fork(), using one process.")
+            pipeline = TaggingPipeline(self.decode_file, self.tag_decoded, self.write_result, stop_event,
+                                       self.a_decode_workers, self.a_batch_size)
+            self.progress.watch_queue("decode", pipeline.work_queue)
+            self.progress.watch_queue("inference", pipeline.decoded_queue)
+            self.progress.watch_queue("write", pipeline.write_queue)
+            pipeline.run(items)
+        # tags that made it to the writer are never lost, even when cancelled
+        if self.writer is not None:
+            self.writer.flush()
+        if self.index is not None:
+            self.index.commit()
+        if self.score_store is not None:
+            self.score_store.commit()
+        if self.claims is not None:
+            self.claims.release_all()
+        tagged = self.progress.counts()["tagged"]
+        if tagged > 0 and not stop_event.is_set():
+            self.throughput.save(self.throughput_key(), tagged / (time.perf_counter() - start))
+        if stop_event.is_set():
+            print("Tagging cancelled.")
+        self.capture_groups.clear()
+        self.progress.finish()
+
+    # decode stage: runs in the decode workers, takes a ScanItem and returns None if there is nothing to tag
+    def decode_file(self, item):
+        try:
+            if not self.needs_tagging(item):
+                return None
+        except Exception as e:
+            self.progress.failed(item.path, "check", e)
+            self.release_claim(item.path)
+            return None
+        decoded = self.decode_image(item)
+        if decoded is None:
+            self.release_claim(item.path)
+        return decoded
+
+    def is_group_tagged(self, item):
+        # a capture group is tagged unless all of its images are tagged already
+        return not self.a_force and all(self.is_tagged(i) for i in [item] + item.members)
+
+    # items come from the plan, so they were checked already. Only with claims another machine
+    # might have tagged them since, then they are checked again
+    def needs_tagging(self, item):
+        if self.claims is not None:
+            if not self.claims.claim(item.path):
+                self.progress.skipped(item.path, "is being tagged on another machine")
+                return False
+            # the sidecars might have been written by another machine since the scan
+            for i in [item] + item.members:
+                i.sidecars = i.sidecars + [s for s in XMPHandler.get_xmp_sidecars_for_image(i.path) if s not in i.sidecars]
+                i.entries = {}
+            start = time.perf_counter()
+            try:
+                if self.is_group_tagged(item):
+                    self.progress.skipped(item.path, "already tagged")
+                    self.release_claim(item.path)
+                    return False
+            finally:
+                self.progress.stage_time("check", time.perf_counter() - start)
+        if len(item.members) > 0:
+            self.capture_groups[item.path] = item.members
+        return True
+
+    def is_tagged(self, item):
+        image_file = item.path
+        sidecar_files = item.sidecars
+        # unchanged files tagged by an earlier run can be skipped without looking at their sidecars
+        if self.index is not None and self.index.is_tagged(image_file, self.a_prefix, item.file_state):
+            return True
+
+        # determine if we already have tagged this image
+        for current_file in sidecar_files:
+            if XMPHandler.file_has_subject_prefix(current_file, self.a_prefix):
+                if self.index is not None and self.a_test is not True:
+                    self.index.record(image_file, sidecar_files, self.a_prefix)
+                return True
+        return False
+
+    def decode_image(self, item):
+        # capture groups are decoded from the cheapest image that can be read, trying the others if that fails
+        start = time.perf_counter()
+        for candidate in [item] + item.members:
+            image = self.decoder.open(candidate.path)
+            if image is None:
+                continue
+            try:
+                tensor = self.preprocessor.prepare(image)
+            except Exception as e:
+                print("Could not decode %s: %s" % (candidate.path, str(e)))
+                continue
+            finally:
+                image.close()
+            self.progress.stage_time("decode", time.perf_counter() - start)
+            return item.path, item.sidecars, tensor
+        self.progress.failed(item.path, "decode")
+        return None
+
+    # inference stage: tags a batch of decoded files. Files which could not be tagged get None instead of tags,
+    # files that got the tags of a near duplicate get its path as the fourth element, and the fifth element is
+    # (scores, embedding) if they are stored
+    def tag_decoded(self, batch):
+        start = time.perf_counter()
+        tensors = [tensor for _, _, tensor in batch]
+        sources = [None] * len(batch)
+        all_tags = [None] * len(batch)
+        outputs = None if self.score_store is None else [None] * len(batch)
+        if self.near_duplicates is not None:
+            hashes = NearDuplicateFilter.hashes(tensors)
+            # index in batch -> index of an earlier, similar image in the batch
+            leaders = {}
+            for i, (image_file, _, _) in enumerate(batch):
+                found = self.near_duplicates.find(image_file, hashes[i])
+                if found is not None:
+                    sources[i], all_tags[i], output = found
+                    if outputs is not None:
+                        outputs[i] = output
+                    continue
+                for j in range(i):
+                    if sources[j] is None and j not in leaders and \
+                            self.near_duplicates.is_similar(image_file, hashes[i], batch[j][0], hashes[j]):
+                        leaders[i] = j
+                        break
+            inferred = self.run_batches([None if sources[i] is not None or i in leaders else tensor
+                                         for i, tensor in enumerate(tensors)], outputs=outputs)
+            for i, tags in enumerate(inferred):
+                if tags is not None:
+                    all_tags[i] = tags
+                    self.near_duplicates.add(batch[i][0], hashes[i], tags, None if outputs is None else outputs[i])
+            for i, j in leaders.items():
+                if all_tags[j] is not None:
+                    sources[i], all_tags[i] = batch[j][0], all_tags[j]
+                    if outputs is not None:
+                        outputs[i] = outputs[j]
+            # the model failed on the image they were compared to, try them on their own
+            retry = [i for i in leaders if all_tags[i] is None]
+            retry_outputs = None if outputs is None else [None] * len(retry)
+            for n, tags in enumerate(self.run_batches([tensors[i] for i in retry], outputs=retry_outputs)):
+                all_tags[retry[n]] = tags
+                if outputs is not None:
+                    outputs[retry[n]] = retry_outputs[n]
+        else:
+            all_tags = self.run_batches(tensors, outputs=outputs)
+        self.progress.stage_time("inference", time.perf_counter() - start, len(batch))
+        results = []
+        for i, ((image_file, sidecar_files, _), tags) in enumerate(zip(batch, all_tags)):
+            res = None if tags is None else [item.strip() for item in tags.split("|") if item.strip() != ""]
+            results.append((image_file, sidecar_files, res, sources[i], None if outputs is None else outputs[i]))
+        return results
+
+    # write stage
+    def write_result(self, result):
+        image_file, sidecar_files, res, source, output = result
+        members = self.capture_groups.pop(image_file, [])
+        if res is None:
+            self.progress.failed(image_file, "tag")
+            self.release_claim(image_file)
+            return
+        self.progress.tagged(image_file, res)
+        if source is not None:
+            self.progress.reused(image_file, source, "near duplicate")
+        for member in members:
+            self.progress.reused(member.path, image_file, "same capture")
+        if output is not None and self.a_test is not True:
+            self.store_scores([image_file] + [m.path for m in members], output)
+        if len(res) > 0:
+            start = time.perf_counter()
+            # the tags go to the sidecars of every image in the capture group
+            for path, sidecars in [(image_file, sidecar_files)] + [(m.path, m.sidecars) for m in members]:
+                try:
+                    self.write_tags(path, sidecars, res)
+                except Exception as e:
+                    self.progress.failed(path, "write", e)
+            self.progress.stage_time("write", time.perf_counter() - start)
+        self.release_claim(image_file, [image_file] + [m.path for m in members])
+
+    def release_claim(self, image_file, written=()):
+        # gives the claim on image_file back once the sidecars of the images written are on disk
+        if self.claims is None:
+            return
+        if self.writer is None or len(written) == 0:
+            self.claims.release(image_file)
+            return
+        sidecars = [s for path in written for s in XMPHandler.possible_names_for_image(path)]
+        self.writer.when_written(sidecars, lambda: self.claims.release(image_file))
+
+    def store_scores(self, image_files, output):
+        try:
+            if self.score_store.vocabulary is None:
+                self.score_store.set_vocabulary(ScoreStore.vocabulary_of(self.model))
+            for image_file in image_files:
+                self.score_store.put(image_file, TagIndex.file_state(image_file), *output)
+        except Exception as e:
+            print("Could not store the scores of %s: %s" % (image_files[0], str(e)))
+
+    def retag_dir(self, img_dir, stop_event, threshold=None, allowed=None):
+        """
+        Writes the tags of every image in img_dir again, computed from the scores stored when it was
+        tagged, without loading the model. Tags with the prefix that don't apply anymore are removed.
+        threshold and allowed are passed to ScoreStore.tags_for.
+        """
+        print("Retagging " + img_dir)
+        self.progress.start()
+        for item in self.progress.counting(DirectoryScanner.scan(img_dir, group_captures=False)):
+            if stop_event.is_set():
+                print("Tagging cancelled.")
+                break
+            stored = self.score_store.get(item.path, item.file_state(item.path))
+            if stored is None:
+                self.progress.skipped(item.path, "has no stored scores")
+                continue
+            res = self.score_store.tags_for(stored[0], threshold, allowed)
+            self.progress.tagged(item.path, res)
+            if len(res) == 0 and len(item.sidecars) == 0:
+                continue
+            try:
+                self.write_tags(item.path, item.sidecars, res, replace=True)
+            except Exception as e:
+                self.progress.failed(item.path, "write", e)
+        if self.writer is not None:
+            self.writer.flush()
+        if self.index is not None:
+            self.index.commit()
+        self.progress.finish()
+
+    def write_tags(self, image_file, sidecar_files, res, replace=False):
+        # replace: remove the tags with the prefix that are not in res
+        handlers = []
+        if len(sidecar_files) == 0:
+            # another file with the same base name might have created a sidecar since the scan
+            sidecar_files = self.sidecars_created_since_scan(image_file)
+        if len(sidecar_files) == 0:
+            if self.a_test is not True:
+                xmp_name = XMPHandler.sidecar_name_for_image(image_file, self.a_prefer_exact)
+                self.progress.message("creating xmp sidecar file at " + xmp_name)
+                handlers.append(XMPHandler(xmp_name, XMPHandler.new_sidecar_content(image_file)))
+            else:
+                self.progress.message("skipping XMP file creation, not writing tags")
+        elif self.writer is not None:
+            self.writer.wait_for(sidecar_files)
+        for current_file in sidecar_files:
+            handlers.append(XMPHandler(current_file))
+        for handler in handlers:
+            if replace:
+                handler.remove_hierarchical_subjects(self.a_prefix, res)
+            for t in res:
+                handler.add_hierarchical_subject(self.a_prefix+"|"+t)
+        if self.a_test is True:
+            return
+
+        written = [handler.path for handler in handlers]
+        if self.writer is None:
+            for handler in handlers:
+                handler.save(self.progress.verbose)
+            self.record_tags(image_file, written, res)
+        else:
+            self.writer.submit([(handler.path, handler.serialize(), handler.original) for handler in handlers],
+                               lambda: self.record_tags(image_file, written, res))
+
+    def sidecars_created_since_scan(self, image_file):
+        candidates = XMPHandler.possible_names_for_image(image_file)
+        if self.writer is None:
+            return [c for c in candidates if os.path.exists(c)]
+        self.writer.wait_for(candidates)
+        return [c for c in candidates if self.writer.has_created(c)]
+
+    def record_tags(self, image_file, sidecar_files, res):
+        if self.index is not None:
+            self.index.record(image_file, sidecar_files, self.a_prefix, res)
 
 
 
@@ -120,6 +543,7 @@ if __name__ == "__main__":
 
     parser.add_argument('imagedir',
                         metavar='DIR',
+                        nargs='?',
                         help='path to dataset')
 
     parser.add_argument('--prefix',
@@ -139,13 +563,318 @@ if __name__ == "__main__":
                         action='store_true',
                         help="write <originial_file_name>.<original_file_extension>.xmp instead of <original_file_name>.xmp")
 
+    parser.add_argument('--batch-size',
+                        metavar='N',
+                        type=int,
+                        help='number of images to run through the model at once (default=8)',
+                        default=8)
+
+    parser.add_argument('--decode-workers',
+                        metavar='N',
+                        type=int,
+                        help='number of threads decoding images while the model is busy (default=2)',
+                        default=2)
+
+    parser.add_argument('--raw-decode',
+                        choices=ImageDecoder.RAW_STRATEGIES,
+                        help='how to decode RAW files: embedded preview (falls back to half), half size or full demosaic (default=preview)',
+                        default='preview')
+
+    parser.add_argument('--index',
+                        metavar='FILE',
+                        help='index of already tagged files (default=<DIR>/%s)' % TagIndex.FILE_NAME)
+
+    parser.add_argument('--no-index',
+                        action='store_true',
+                        help="don't use an index, check the XMP files of every image")
+
+    parser.add_argument('--rebuild-index',
+                        action='store_true',
+                        help='forget everything in the index and check the XMP files of every image again')
+
+    parser.add_argument('--verify-index',
+                        action='store_true',
+                        help='check every entry of the index against the files and XMP files before tagging')
+
+    parser.add_argument('--writers',
+                        metavar='N',
+                        type=int,
+                        help='number of threads writing XMP files in the background, 0 writes them directly (default=4)',
+                        default=4)
+
+    parser.add_argument('--workers',
+                        metavar='N',
+                        type=int,
+                        help='number of tagging processes sharing one copy of the model, CPU only (default=1)',
+                        default=1)
+
+    parser.add_argument('--threads-per-worker',
+                        metavar='N',
+                        type=int,
+                        help='torch threads for each worker process (default=number of cores / workers)')
+
+    parser.add_argument('--precision',
+                        choices=InferenceMode.PRECISIONS,
+                        help='run the model in full precision, with bf16 autocast or with int8 quantized linear layers (CPU only) (default=fp32)',
+                        default='fp32')
+
+    parser.add_argument('--channels-last',
+                        action='store_true',
+                        help='use channels_last memory layout for the model')
+
+    parser.add_argument('--compile',
+                        action='store_true',
+                        help='compile the image encoder with torch.compile, if available')
+
+    parser.add_argument('--check-precision',
+                        metavar='N',
+                        type=int,
+                        help="don't tag, compare the tags of up to N images in DIR with the chosen precision against fp32")
+
+    parser.add_argument('--no-capture-groups',
+                        action='store_true',
+                        help="tag every image on its own, even files with the same name and different extensions (like IMG_0001.JPG and IMG_0001.CR2)")
+
+    parser.add_argument('--near-duplicates',
+                        action='store_true',
+                        help="reuse the tags of a recently tagged, nearly identical image in the same directory, like the frames of a burst")
+
+    parser.add_argument('--near-duplicate-window',
+                        type=int,
+                        default=8,
+                        metavar='N',
+                        help="compare with the last N images that were run through the model (default 8)")
+
+    parser.add_argument('--near-duplicate-distance',
+                        type=int,
+                        default=5,
+                        metavar='BITS',
+                        help="how many of the 64 bits of the perceptual hashes may differ (default 5)")
+
+    parser.add_argument('--store-scores',
+                        action='store_true',
+                        help="keep the score of every tag for every image, so --retag can change tags without the model")
+
+    parser.add_argument('--store-embeddings',
+                        action='store_true',
+                        help="also keep the image embeddings of the model (implies --store-scores)")
+
+    parser.add_argument('--scores',
+                        metavar='DIR',
+                        help='where the scores are kept (default=<DIR>/%s)' % ScoreStore.DIR_NAME)
+
+    parser.add_argument('--retag',
+                        action='store_true',
+                        help="write the tags again from the stored scores, with --prefix, --threshold and --vocabulary, without loading the model")
+
+    parser.add_argument('--threshold',
+                        type=float,
+                        metavar='SCORE',
+                        help="with --retag: tag every class scored above SCORE (0 to 1) instead of using the thresholds of the model")
+
+    parser.add_argument('--vocabulary',
+                        metavar='FILE',
+                        help="with --retag: only write the tags listed in FILE, one per line")
+
+    parser.add_argument('--shard',
+                        metavar='I/N',
+                        help="only tag the I-th of N parts of DIR, for tagging one tree on N machines")
+
+    parser.add_argument('--claims',
+                        action='store_true',
+                        help="coordinate with other machines tagging DIR through claim files, so no image is tagged twice")
+
+    parser.add_argument('--claim-dir',
+                        metavar='DIR',
+                        help='where the claim files are kept (default=<DIR>/%s)' % ClaimDirectory.DIR_NAME)
+
+    parser.add_argument('--claim-timeout',
+                        type=float,
+                        default=600.0,
+                        metavar='SECONDS',
+                        help="claims not refreshed for SECONDS are taken over, they are left behind by machines that crashed (default 600)")
+
+    parser.add_argument('--plan',
+                        action='store_true',
+                        help="only show how many files would be tagged, by format, and how long it would take, without loading the model")
+
+    parser.add_argument('--quiet',
+                        action='store_true',
+                        help="don't print a line for every file, only errors and summaries")
+
+    parser.add_argument('--events',
+                        metavar='FILE',
+                        help='write a JSON line for every file and summary to FILE, - for stdout')
+
+    parser.add_argument('--summary-interval',
+                        metavar='SECONDS',
+                        type=float,
+                        help='print a summary with images/s and ETA every SECONDS seconds')
+
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help='keep running and tag new and changed images in DIR as they appear')
+
+    parser.add_argument('--poll-interval',
+                        metavar='SECONDS',
+                        type=float,
+                        help='with --watch, look for new images every SECONDS seconds instead of using inotify (e.g. on network shares)')
+
+    parser.add_argument('--settle-time',
+                        metavar='SECONDS',
+                        type=float,
+                        help="with --watch, wait until a file didn't change for SECONDS seconds before tagging it (default=2)",
+                        default=2.0)
+
+    parser.add_argument('--serve',
+                        action='store_true',
+                        help='keep the model loaded and tag the directories sent by clients, DIR is not needed')
+
+    parser.add_argument('--client',
+                        action='store_true',
+                        help='let a running STAG service (--serve) tag DIR instead of loading the model')
+
+    parser.add_argument('--port',
+                        metavar='N',
+                        type=int,
+                        help='port of the STAG service on localhost (default=%d)' % DEFAULT_PORT,
+                        default=DEFAULT_PORT)
+
     args = parser.parse_args()
-    pretrained = hf_hub_download(repo_id="xinyu1205/recognize-anything-plus-model",
-                                 filename="ram_plus_swin_large_14m.pth")
+    if args.imagedir is None and not args.serve:
+        parser.error("DIR is required")
 
-    tagger = SKTagger(pretrained, 384, args.force, args.test, args.prefer_exact_filenames, args.prefix)
-    stop_event = threading.Event()
-    stop_event.clear()
-    tagger.enter_dir(args.imagedir, stop_event)
+    if args.client:
+        try:
+            job = DaemonClient(args.port).run(path=os.path.abspath(args.imagedir), prefix=args.prefix,
+                                              force=args.force, test=args.test,
+                                              prefer_exact_filenames=args.prefer_exact_filenames,
+                                              index=not args.no_index)
+        except KeyboardInterrupt:
+            sys.exit(1)
+        except Exception as e:
+            print("Could not reach the STAG service: ", str(e))
+            sys.exit(1)
+        sys.exit(0 if job["state"] == "done" else 1)
 
+    events = None
+    if args.events == "-":
+        events = sys.stdout
+    elif args.events is not None:
+        events = open(args.events, "a")
+    progress = Progress(not args.quiet, events, args.summary_interval)
 
+    score_store = None
+    if (args.store_scores or args.store_embeddings or args.retag) and not args.serve and (args.retag or not args.plan):
+        score_store = ScoreStore(args.scores or ScoreStore.default_path(args.imagedir), args.store_embeddings)
+
+    if args.retag:
+        if score_store.vocabulary is None:
+            print("No scores stored in", score_store.path, "- tag with --store-scores first.")
+            sys.exit(1)
+        allowed = None
+        if args.vocabulary is not None:
+            with open(args.vocabulary, encoding="utf-8") as f:
+                allowed = set(line.strip() for line in f if line.strip() != "")
+        index = None if args.no_index else TagIndex(args.index or TagIndex.default_path(args.imagedir))
+        writer = SidecarWriter(args.writers, verbose=not args.quiet) if args.writers > 0 else None
+        # the model is never loaded, so there is no checkpoint to pass
+        tagger = SKTagger(None, 384, args.force, args.test, args.prefer_exact_filenames, args.prefix,
+                          a_index=index, a_writer=writer, a_progress=progress, a_score_store=score_store)
+        try:
+            tagger.retag_dir(args.imagedir, threading.Event(), args.threshold, allowed)
+        finally:
+            if writer is not None:
+                writer.close()
+            if index is not None:
+                index.close()
+            score_store.close()
+        sys.exit(0)
+
+    # None if it isn't downloaded yet, that happens when the model is needed
+    pretrained = ModelStore.cached_checkpoint()
+
+    near_duplicates = None
+    if args.near_duplicates:
+        near_duplicates = NearDuplicateFilter(args.near_duplicate_window, args.near_duplicate_distance)
+
+    inference_mode = InferenceMode(args.precision, args.channels_last, args.compile)
+    if args.check_precision is not None:
+        tagger = SKTagger(pretrained, 384, args.force, True, args.prefer_exact_filenames, args.prefix,
+                          args.batch_size, args.decode_workers, args.raw_decode)
+        inference_mode.check_against_fp32(tagger, args.imagedir, args.check_precision)
+        sys.exit(0)
+
+    if args.serve:
+        writer = SidecarWriter(args.writers, verbose=not args.quiet) if args.writers > 0 else None
+        tagger = SKTagger(pretrained, 384, args.force, args.test, args.prefer_exact_filenames, args.prefix,
+                          args.batch_size, args.decode_workers, args.raw_decode, None, writer,
+                          args.workers, args.threads_per_worker, inference_mode, progress, not args.no_capture_groups,
+                          near_duplicates)
+        tagger.load_model()
+        TaggingDaemon(tagger, writer, args.port).serve_forever()
+        if writer is not None:
+            writer.close()
+        sys.exit(0)
+
+    index = None
+    if args.plan:
+        # a dry run, without creating or changing the index
+        index_path = args.index or TagIndex.default_path(args.imagedir)
+        if not args.no_index and os.path.exists(index_path):
+            index = TagIndex(index_path, read_only=True)
+    elif not args.no_index:
+        index = TagIndex(args.index or TagIndex.default_path(args.imagedir))
+        if args.rebuild_index:
+            index.clear()
+        elif args.verify_index:
+            valid, dropped = index.verify(args.prefix, XMPHandler.file_has_subject_prefix)
+            print("Index verified: %d entries valid, %d dropped" % (valid, dropped))
+
+    writer = SidecarWriter(args.writers, verbose=not args.quiet) if args.writers > 0 else None
+
+    shard = None
+    if args.shard is not None:
+        try:
+            shard = Shard.parse(args.shard, args.imagedir)
+        except ValueError as e:
+            parser.error("--shard: " + str(e))
+    claims = None
+    if args.claims and not args.plan:
+        claims = ClaimDirectory(args.imagedir, args.claim_dir or ClaimDirectory.default_path(args.imagedir),
+                                args.claim_timeout)
+
+    tagger = SKTagger(pretrained, 384, args.force, args.test, args.prefer_exact_filenames, args.prefix,
+                      args.batch_size, args.decode_workers, args.raw_decode, index, writer,
+                      args.workers, args.threads_per_worker, inference_mode, progress, not args.no_capture_groups,
+                      near_duplicates, score_store, shard, claims)
+    if args.plan:
+        tagger.plan_dir(args.imagedir)
+        if index is not None:
+            index.close()
+        sys.exit(0)
+
+    stop_event = threading.Event()
+    stop_event.clear()
+    exit_code = 0
+    try:
+        if args.watch:
+            try:
+                tagger.watch_dir(args.imagedir, stop_event, args.poll_interval, args.settle_time)
+            except KeyboardInterrupt:
+                stop_event.set()
+                print("Stopped watching.")
+        else:
+            tagger.enter_dir(args.imagedir, stop_event)
+    except RuntimeError as e:
+        print(str(e))
+        exit_code = 1
+    if writer is not None:
+        writer.close()
+    if index is not None:
+        index.close()
+    if score_store is not None:
+        score_store.close()
+    if claims is not None:
+        claims.close()
+    sys.exit(exit_code)
@@ -12,34 +12,55 @@ from tkinter import filedialog, ttk, messagebox
 import threading
 import sys
 import ctypes
+import collections
 
-import huggingface_hub
 from PIL import Image, ImageTk
 import webbrowser
 from stag import SKTagger
+from tagindex import TagIndex
+from sidecarwriter import SidecarWriter
+from modelstore import ModelStore
+from daemon import DaemonClient
+from progress import Progress
 from tktooltip import ToolTip
-from huggingface_hub import hf_hub_download
 
 
 
+# lines kept in the output window, older ones are dropped
+MAX_OUTPUT_LINES = 5000
+# how often the output window and the progress bar are updated, in ms
+UPDATE_INTERVAL = 100
+
+
 class TextRedirector:
-    def __init__(self, text_widget, tag="stdout"):
-        self.text_widget = text_widget
+    # collects output from any thread, the Tk thread picks it up in update_output(). Never touches Tk itself
+
+    # print() writes the text and the line break separately
+    pending = collections.deque(maxlen=2 * MAX_OUTPUT_LINES)
+
+    def __init__(self, tag="stdout"):
         self.tag = tag
 
     def write(self, out_str):
-        self.text_widget.insert(tk.END, out_str, (self.tag,))
-        self.text_widget.see(tk.END)
-        self.text_widget.update_idletasks()
+        TextRedirector.pending.append((self.tag, out_str))
 
     def flush(self):
         pass
 
 stop_event = threading.Event()
+finished_event = threading.Event()
+tagger = None
+# returns the progress of the current run as a Progress.snapshot(), or None
+progress_source = None
 
 def run_tagger():
+    global progress_source
     stop_event.clear()
+    finished_event.clear()
+    progress_source = None
     update_ui_state(running=True)
+    progress_bar.config(value=0)
+    progress_label.config(text="")
 
     imagedir = entry_imagedir.get()
     prefix = entry_prefix.get() or 'st'
@@ -47,32 +68,111 @@ def run_tagger():
     test = var_test.get()
     prefer_exact_filenames = var_prefer_exact_filenames.get()
 
-    threading.Thread(target=run_tagger_directly, args=(imagedir, prefix, force, test, prefer_exact_filenames, stop_event)).start()
-
-def run_tagger_directly(imagedir, prefix, force, test, prefer_exact_filenames, stop_event):
-    sys.stdout = TextRedirector(text_output, "stdout")
-    sys.stderr = TextRedirector(text_output, "stderr")
-
-    print("Starting tagger...")
+    # a running STAG service already has the model loaded
+    use_service = DaemonClient().is_running()
 
     # check if model was already downloaded
-    dl_dir = os.path.join(huggingface_hub.constants.HF_HUB_CACHE,"models--xinyu1205--recognize-anything-plus-model")
-    if not os.path.isdir(dl_dir):
+    if not use_service and tagger is None and ModelStore.cached_checkpoint() is None:
         show_startup_alert()
         print("First run – now downloading the model file.")
         print("This process can take a little while and is only executed once.")
 
-    pretrained = hf_hub_download(repo_id="xinyu1205/recognize-anything-plus-model", filename="ram_plus_swin_large_14m.pth")
+    threading.Thread(target=run_tagger_directly, daemon=True,
+                     args=(imagedir, prefix, force, test, prefer_exact_filenames, stop_event, use_service)).start()
 
-    tagger = SKTagger(pretrained, 384, force, test, prefer_exact_filenames, prefix)
+def run_tagger_directly(imagedir, prefix, force, test, prefer_exact_filenames, stop_event, use_service=False):
+    try:
+        if use_service:
+            run_with_service(imagedir, prefix, force, test, prefer_exact_filenames, stop_event)
+        else:
+            run_in_process(imagedir, prefix, force, test, prefer_exact_filenames, stop_event)
+        print("The mighty STAG has done its work. Have a nice day.")
+    except Exception as e:
+        print("Tagging failed: ", str(e))
+    finally:
+        # the Tk thread updates the buttons
+        finished_event.set()
 
-    if not stop_event.is_set():
-        tagger.enter_dir(imagedir, stop_event)
+def run_with_service(imagedir, prefix, force, test, prefer_exact_filenames, stop_event):
+    global progress_source
+    print("Starting tagger...")
+    latest = [None]
+    progress_source = lambda: latest[0]
 
-    print("The mighty STAG has done its work. Have a nice day.")
+    def on_progress(snapshot):
+        latest[0] = snapshot
 
-    # After the tagger finishes or is cancelled
-    update_ui_state(running=False)
+    DaemonClient().run(stop_event, on_progress=on_progress, path=os.path.abspath(imagedir), prefix=prefix,
+                       force=force, test=test, prefer_exact_filenames=prefer_exact_filenames)
+
+def run_in_process(imagedir, prefix, force, test, prefer_exact_filenames, stop_event):
+    global tagger, progress_source
+    print("Starting tagger...")
+
+    index = TagIndex(TagIndex.default_path(imagedir))
+    writer = SidecarWriter()
+    if tagger is None:
+        # downloaded when the model is loaded, which is only done if there is something to tag
+        pretrained = ModelStore.cached_checkpoint()
+        tagger = SKTagger(pretrained, 384, force, test, prefer_exact_filenames, prefix, a_index=index, a_writer=writer,
+                          a_progress=Progress())
+    else:
+        # keep the model loaded by an earlier run
+        tagger.configure_run(force, test, prefer_exact_filenames, prefix, index, writer)
+    progress_source = tagger.progress.snapshot
+
+    try:
+        if not stop_event.is_set():
+            tagger.enter_dir(imagedir, stop_event)
+    finally:
+        writer.close()
+        index.close()
+
+def update_output():
+    # runs in the Tk thread every UPDATE_INTERVAL ms: shows new output and progress
+    if len(TextRedirector.pending) > 0:
+        at_end = text_output.yview()[1] >= 1.0
+        # one insert per run of output with the same tag, inserting is what's slow
+        chunks = []
+        while len(TextRedirector.pending) > 0:
+            tag, out_str = TextRedirector.pending.popleft()
+            if len(chunks) > 0 and chunks[-1][0] == tag:
+                chunks[-1][1].append(out_str)
+            else:
+                chunks.append((tag, [out_str]))
+        for tag, parts in chunks:
+            text_output.insert(tk.END, "".join(parts), (tag,))
+        lines = int(text_output.index("end-1c").split(".")[0])
+        if lines > MAX_OUTPUT_LINES:
+            text_output.delete("1.0", "%d.0" % (lines - MAX_OUTPUT_LINES + 1))
+        # don't scroll away from what the user is reading
+        if at_end:
+            text_output.see(tk.END)
+
+    snapshot = progress_source() if progress_source is not None else None
+    if snapshot is not None:
+        update_progress(snapshot)
+
+    if finished_event.is_set():
+        finished_event.clear()
+        update_ui_state(running=False)
+    root.after(UPDATE_INTERVAL, update_output)
+
+def update_progress(snapshot):
+    counters = snapshot["counters"]
+    total = snapshot["total"]
+    if total:
+        progress_bar.config(maximum=total, value=min(snapshot["done"], total))
+        text = "%d of %d files" % (snapshot["done"], total)
+    else:
+        # the scan is still running, so the total isn't known yet
+        progress_bar.config(maximum=max(1, counters["found"]), value=snapshot["done"])
+        text = "%d of %d+ files" % (snapshot["done"], counters["found"])
+    text += ", %d tagged, %d skipped, %d failed, %.2f images/s" % (
+        counters["tagged"], counters["skipped"], counters["failed"], snapshot["images_per_s"])
+    if snapshot["eta_s"] is not None and total and snapshot["done"] < total:
+        text += ", ETA " + Progress.format_duration(snapshot["eta_s"])
+    progress_label.config(text=text)
 
 def cancel_tagger():
     print("Cancelling tagger...")
@@ -239,9 +339,18 @@ if __name__ == '__main__':
     scrollbar.grid(row=0, column=1, sticky='ns')
     text_output['yscrollcommand'] = scrollbar.set
 
+    progress_bar = ttk.Progressbar(text_frame, mode="determinate")
+    progress_bar.grid(row=1, column=0, columnspan=2, pady=(5, 0), sticky="ew")
+    progress_label = ttk.Label(text_frame, text="")
+    progress_label.grid(row=2, column=0, columnspan=2, sticky=tk.W)
+
     text_frame.columnconfigure(0, weight=1)
     text_frame.rowconfigure(0, weight=1)
 
     cancel_button.config(state='disabled')
 
+    sys.stdout = TextRedirector("stdout")
+    sys.stderr = TextRedirector("stderr")
+    root.after(UPDATE_INTERVAL, update_output)
+
     root.mainloop()
@@ -0,0 +1,153 @@
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+
+
+class TagIndex:
+    """
+    Remembers which images were already tagged, so re-runs don't have to parse the XMP sidecars
+    of unchanged files. Entries are keyed by the path of the image and only trusted as long as size
+    and mtime of the image and of all of its sidecars are still the same as when they were recorded.
+    """
+
+    FILE_NAME = ".stag_index.sqlite"
+
+    # commit after this many changes, committing every single one is slow
+    COMMIT_INTERVAL = 100
+
+    @staticmethod
+    def default_path(img_dir):
+        return os.path.join(img_dir, TagIndex.FILE_NAME)
+
+    @staticmethod
+    def file_state(path):
+        # (size, mtime in ns) of a file, or None if it doesn't exist
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def __init__(self, index_path, read_only=False):
+        self.path = index_path
+        self.read_only = read_only
+        self.pending = 0
+        self.lock = threading.Lock()
+        if read_only:
+            # doesn't create or change anything, the index has to exist
+            self.db = sqlite3.connect("file:%s?mode=ro" % urllib.request.pathname2url(os.path.abspath(index_path)),
+                                      uri=True, check_same_thread=False)
+            return
+        self.db = sqlite3.connect(index_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sidecars TEXT NOT NULL,
+                prefix TEXT NOT NULL,
+                state TEXT NOT NULL,
+                tags TEXT,
+                updated REAL NOT NULL
+            )""")
+        self.db.commit()
+
+    def is_tagged(self, image_file, prefix, file_state=None):
+        # True if the image was tagged with prefix and neither the image nor its sidecars changed since.
+        # file_state(path) can supply (size, mtime in ns) of files that were already looked at
+        if file_state is None:
+            file_state = TagIndex.file_state
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, sidecars, prefix FROM files WHERE path = ? AND state = 'tagged'",
+                                  (os.path.abspath(image_file),)).fetchone()
+        if row is None or row[3].lower() != prefix.lower():
+            return False
+        if file_state(image_file) != (row[0], row[1]):
+            return False
+        for sidecar, size, mtime_ns in json.loads(row[2]):
+            if file_state(sidecar) != (size, mtime_ns):
+                return False
+        return True
+
+    def record(self, image_file, sidecar_files, prefix, tags=None, state="tagged"):
+        if self.read_only:
+            return
+        image_state = TagIndex.file_state(image_file)
+        if image_state is None:
+            return
+        sidecars = []
+        for sidecar in sidecar_files:
+            sidecar_state = TagIndex.file_state(sidecar)
+            if sidecar_state is not None:
+                sidecars.append([os.path.abspath(sidecar), sidecar_state[0], sidecar_state[1]])
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (os.path.abspath(image_file), image_state[0], image_state[1], json.dumps(sidecars),
+                             prefix, state, None if tags is None else "|".join(tags), time.time()))
+            self.pending += 1
+            if self.pending >= TagIndex.COMMIT_INTERVAL:
+                self.db.commit()
+                self.pending = 0
+
+    def forget(self, image_file):
+        if self.read_only:
+            return
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(image_file),))
+            self.pending += 1
+
+    def clear(self):
+        # forget everything, the next run checks every sidecar again and rebuilds the index
+        if self.read_only:
+            return
+        with self.lock:
+            self.db.execute("DELETE FROM files")
+            self.db.commit()
+            self.pending = 0
+
+    def verify(self, prefix, has_prefix):
+        """
+        Checks every entry against the file system and drops the ones that can't be trusted anymore.
+        has_prefix(sidecar_path, prefix) is used to check that the sidecars still contain the tags.
+        Returns (number of valid entries, number of dropped entries)
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT path FROM files").fetchall()
+        valid = 0
+        dropped = 0
+        for (image_file,) in rows:
+            if self.is_tagged(image_file, prefix) and self.sidecars_have_prefix(image_file, prefix, has_prefix):
+                valid += 1
+            else:
+                self.forget(image_file)
+                dropped += 1
+        self.commit()
+        return valid, dropped
+
+    def sidecars_have_prefix(self, image_file, prefix, has_prefix):
+        with self.lock:
+            row = self.db.execute("SELECT sidecars FROM files WHERE path = ?", (os.path.abspath(image_file),)).fetchone()
+        if row is None:
+            return False
+        for sidecar, _, _ in json.loads(row[0]):
+            try:
+                if has_prefix(sidecar, prefix):
+                    return True
+            except Exception as e:
+                print("Could not read ", sidecar, " because of ", str(e))
+        return False
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
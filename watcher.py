@@ -0,0 +1,275 @@
+
+#############################################
+## Watching a directory for new images      #
+#############################################
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from scanner import DirectoryScanner, ScanItem
+from xmphandler import XMPHandler
+
+
+class _Inotify:
+    """
+    Minimal inotify binding via ctypes, watching a directory tree for files being written,
+    moved in or created. Only available on Linux.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+
+    EVENT = struct.Struct("iIII")
+
+    @staticmethod
+    def is_available():
+        return sys.platform.startswith("linux") and ctypes.util.find_library("c") is not None
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(_Inotify.IN_NONBLOCK | _Inotify.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> directory
+        self.directories = {}
+
+    def add_tree(self, top):
+        # watches top and everything below, returns the directories that are watched now
+        added = []
+        pending = [top]
+        while len(pending) > 0:
+            directory = pending.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), _Inotify.MASK)
+            if wd < 0:
+                print("Could not watch directory ", directory, " because of ", os.strerror(ctypes.get_errno()))
+                continue
+            self.directories[wd] = directory
+            added.append(directory)
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False) and not DirectoryScanner.is_hidden(entry.name):
+                            pending.append(entry.path)
+            except OSError:
+                pass
+        return added
+
+    def read(self, timeout):
+        """
+        Waits up to timeout seconds for events. Returns (paths of files written, moved in or created,
+        new directories, True if events were lost)
+        """
+        files = []
+        new_dirs = []
+        overflow = False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return files, new_dirs, overflow
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return files, new_dirs, overflow
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _Inotify.EVENT.unpack_from(data, offset)
+            offset += _Inotify.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & _Inotify.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & _Inotify.IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or name == "" or DirectoryScanner.is_hidden(name):
+                continue
+            path = os.path.join(directory, name)
+            if mask & _Inotify.IN_ISDIR:
+                if mask & (_Inotify.IN_CREATE | _Inotify.IN_MOVED_TO):
+                    new_dirs.append(path)
+            else:
+                files.append(path)
+        return files, new_dirs, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    """
+    Finds images that are added to or changed in a directory tree after the watcher was created.
+    Uses inotify where available, otherwise polls: only directories whose mtime changed are listed
+    again, and only files that are still settling are stat'ed every time.
+
+    A file is reported once its size and mtime didn't change for settle_time seconds,
+    so files that are still being copied aren't tagged half-written.
+    """
+
+    # when polling, files that appeared this many seconds ago are stat'ed directly on every poll,
+    # writes to existing files don't change the mtime of their directory
+    RECENT_TIME = 60.0
+
+    def __init__(self, img_dir, poll_interval=None, settle_time=2.0):
+        self.img_dir = img_dir
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        # path -> (size, mtime_ns, time that state was first seen)
+        self.settling = {}
+        self.inotify = None
+        if poll_interval is None and _Inotify.is_available():
+            try:
+                self.inotify = _Inotify()
+                self.inotify.add_tree(img_dir)
+            except OSError as e:
+                print("inotify is not available, polling instead: ", str(e))
+                self.inotify = None
+        if self.inotify is None:
+            if self.poll_interval is None:
+                self.poll_interval = 5.0
+            # directory -> (mtime_ns, {name: (size, mtime_ns)}, [subdirectories])
+            self.directories = {}
+            # path -> time it was first seen
+            self.recent = {}
+            self.poll(report=False)
+
+    @staticmethod
+    def is_candidate(path):
+        name = os.path.basename(path)
+        return not DirectoryScanner.is_hidden(name) and not XMPHandler.is_xmp_file(name)
+
+    def method(self):
+        return "inotify" if self.inotify is not None else "polling every %gs" % self.poll_interval
+
+    def batches(self, stop_event):
+        # yields lists of ScanItems for the files that settled since the last batch, until stop_event is set
+        while not stop_event.is_set():
+            if self.inotify is not None:
+                files, new_dirs, overflow = self.inotify.read(min(0.5, self.settle_time))
+                for directory in new_dirs:
+                    for watched in self.inotify.add_tree(directory):
+                        files.extend(self.list_files(watched))
+                if overflow:
+                    print("Too many changes at once, looking at the whole directory again")
+                    files.extend(item.path for item in DirectoryScanner.scan(self.img_dir, group_captures=False))
+                for path in files:
+                    self.touch(path)
+            else:
+                if stop_event.wait(self.poll_interval):
+                    break
+                for path in self.poll():
+                    self.touch(path)
+            ready = self.settled()
+            if len(ready) > 0:
+                yield [ScanItem.for_file(path) for path in sorted(ready)]
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def list_files(self, directory):
+        try:
+            with os.scandir(directory) as it:
+                return [entry.path for entry in it if entry.is_file(follow_symlinks=False)]
+        except OSError:
+            return []
+
+    def touch(self, path):
+        # path was written to, it has to settle (again) before it's reported
+        if DirectoryWatcher.is_candidate(path):
+            self.settling[path] = None
+
+    def settled(self):
+        now = time.monotonic()
+        ready = []
+        for path, seen in list(self.settling.items()):
+            try:
+                st = os.stat(path)
+            except OSError:
+                # gone again, like temporary files
+                del self.settling[path]
+                continue
+            state = (st.st_size, st.st_mtime_ns)
+            if seen is None or seen[:2] != state:
+                self.settling[path] = state + (now,)
+            elif now - seen[2] >= self.settle_time:
+                ready.append(path)
+                del self.settling[path]
+        return ready
+
+    def poll(self, report=True):
+        # returns files that are new or changed since the last poll. Files changed in place long after
+        # they were added don't change the mtime of their directory and aren't noticed
+        now = time.monotonic()
+        changed = []
+        pending = [self.img_dir]
+        seen = set()
+        while len(pending) > 0:
+            directory = pending.pop()
+            seen.add(directory)
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            known = self.directories.get(directory)
+            if known is not None and known[0] == mtime_ns:
+                # nothing was added, removed or renamed, only the subdirectories have to be checked
+                pending.extend(known[2])
+                continue
+            files = {}
+            subdirs = []
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if DirectoryScanner.is_hidden(entry.name):
+                            continue
+                        if entry.is_dir():
+                            # links to directories aren't followed, like in the scan
+                            if not entry.is_symlink():
+                                subdirs.append(entry.path)
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            files[entry.name] = (st.st_size, st.st_mtime_ns)
+            except OSError as e:
+                print("Could not read directory ", directory, " because of ", str(e))
+                continue
+            pending.extend(subdirs)
+            old_files = {} if known is None else known[1]
+            for name, state in files.items():
+                if old_files.get(name) != state:
+                    changed.append(os.path.join(directory, name))
+                    if name not in old_files and report:
+                        self.recent[os.path.join(directory, name)] = now
+            self.directories[directory] = (mtime_ns, files, subdirs)
+        for directory in list(self.directories):
+            if directory not in seen:
+                del self.directories[directory]
+
+        for path, first_seen in list(self.recent.items()):
+            directory, name = os.path.split(path)
+            known = self.directories.get(directory)
+            if now - first_seen > DirectoryWatcher.RECENT_TIME or known is None or name not in known[1]:
+                del self.recent[path]
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            state = (st.st_size, st.st_mtime_ns)
+            if known[1][name] != state:
+                known[1][name] = state
+                if path not in changed:
+                    changed.append(path)
+        return changed if report else []
@@ -0,0 +1,127 @@
+
+#############################################
+## Multi-process tagging                    #
+#############################################
+
+import multiprocessing
+import os
+import queue
+import threading
+
+import torch
+
+from pipeline import TaggingPipeline
+from progress import Progress
+
+
+def _tasks(tasks, stop):
+    while not stop.is_set():
+        try:
+            task = tasks.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if task is None:
+            return
+        yield task
+
+
+def _worker_main(tagger, threads, tasks, results, stop):
+    # runs in the forked worker: decodes and tags its share of the files, the parent writes the tags
+    # and keeps the count, so files that can't be decoded are sent back without tags, too
+    torch.set_num_threads(threads)
+    tagger.progress = Progress(tagger.progress.verbose)
+
+    def decode(item):
+        decoded = tagger.decode_image(item)
+        if decoded is None:
+            results.put((item.path, item.sidecars, None, None, None))
+        return decoded
+
+    pipeline = TaggingPipeline(decode, tagger.tag_decoded, results.put, stop,
+                               tagger.a_decode_workers, tagger.a_batch_size)
+    pipeline.run(_tasks(tasks, stop))
+    results.put(None)
+
+
+class ProcessTagger:
+    """
+    Spreads the files to tag over several worker processes, each running its own decode and
+    inference pipeline with a few torch threads. On CPUs with many cores this scales a lot better
+    than one process with many intra-op threads.
+
+    The workers are forked after the model was loaded, so they share its weights with the parent
+    instead of loading them again. The parent checks which files need tagging and writes
+    the tags the workers send back, just like the single process pipeline.
+    """
+
+    @staticmethod
+    def is_supported(device):
+        # CUDA doesn't survive a fork, and without fork every worker would have to load the model itself
+        return device.type == "cpu" and "fork" in multiprocessing.get_all_start_methods()
+
+    def __init__(self, tagger, workers, threads_per_worker=None):
+        self.tagger = tagger
+        self.workers = max(1, workers)
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // self.workers)
+        self.threads_per_worker = threads_per_worker
+
+    def run(self, items, stop_event):
+        ctx = multiprocessing.get_context("fork")
+        tasks = ctx.Queue(maxsize=2 * self.workers * self.tagger.a_batch_size)
+        results = ctx.Queue()
+        stop = ctx.Event()
+
+        print("Tagging with %d worker processes, %d threads each" % (self.workers, self.threads_per_worker))
+        # load before forking, the workers must not each load their own copy
+        self.tagger.load_model()
+        processes = [ctx.Process(target=_worker_main, daemon=True,
+                                 args=(self.tagger, self.threads_per_worker, tasks, results, stop))
+                     for _ in range(self.workers)]
+        for p in processes:
+            p.start()
+        feeder = threading.Thread(target=self._feed, args=(items, tasks, stop_event, stop), daemon=True)
+        feeder.start()
+
+        running = len(processes)
+        while running > 0:
+            if stop_event.is_set():
+                stop.set()
+            try:
+                result = results.get(timeout=0.1)
+            except queue.Empty:
+                if not any(p.is_alive() for p in processes):
+                    print("All worker processes have ended unexpectedly.")
+                    break
+                continue
+            if result is None:
+                running -= 1
+            else:
+                self.tagger.write_result(result)
+
+        stop.set()
+        feeder.join()
+        for p in processes:
+            p.join()
+
+    def _put(self, tasks, task, stop):
+        while not stop.is_set():
+            try:
+                tasks.put(task, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _feed(self, items, tasks, stop_event, stop):
+        try:
+            for item in items:
+                if stop_event.is_set() or stop.is_set():
+                    return
+                if self.tagger.needs_tagging(item) and not self._put(tasks, item.without_entries(), stop):
+                    return
+        except Exception as e:
+            print("Listing files failed: ", str(e))
+        for _ in range(self.workers):
+            if not self._put(tasks, None, stop):
+                return
@@ -1,5 +1,19 @@
+import io
 import os
-from bs4 import BeautifulSoup
+from lxml import etree
+
+from sidecarwriter import SidecarWriter
+
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+DC = "http://purl.org/dc/elements/1.1/"
+LR = "http://ns.adobe.com/lightroom/1.0/"
+EXIF = "http://ns.adobe.com/exif/1.0/"
+XMP_MM = "http://ns.adobe.com/xap/1.0/mm/"
+XML = "http://www.w3.org/XML/1998/namespace"
+
+# characters XML counts as whitespace
+XML_SPACES = str.maketrans("", "", " \n\t\f\r")
+
 
 class XMPHandler:
 
@@ -36,15 +50,16 @@ class XMPHandler:
                 return current
 
     @staticmethod
-    def create_xmp_sidecar(image_filename, prefer_exact_filenames):
-        filename, file_extension = os.path.splitext(image_filename)
-        xmp_name = None
+    def sidecar_name_for_image(image_filename, prefer_exact_filenames):
         if prefer_exact_filenames:
-            xmp_name = image_filename + ".xmp"
-        else:
-            xmp_name = filename + ".xmp"
+            return image_filename + ".xmp"
+        filename, file_extension = os.path.splitext(image_filename)
+        return filename + ".xmp"
+
+    @staticmethod
+    def new_sidecar_content(image_filename):
         basename = os.path.basename(image_filename)
-        soup = BeautifulSoup("""
+        document, declarations = XMPHandler.parse(io.BytesIO(b"""
                 <x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 4.4.0-Exiv2">
                  <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
                   <rdf:Description rdf:about=""
@@ -54,104 +69,259 @@ class XMPHandler:
                   </rdf:Description>
                  </rdf:RDF>
                 </x:xmpmeta>
-                """, "xml")
-        desc = soup("rdf:Description")[0]
-        desc["xmpMM:DerivedFrom"] = basename
+                """))
+        desc = next(document.getroot().iter("{%s}Description" % RDF))
+        desc.set("{%s}DerivedFrom" % XMP_MM, basename)
+        return XMPHandler.serialize_document(document, declarations)
+
+    @staticmethod
+    def create_xmp_sidecar(image_filename, prefer_exact_filenames):
+        xmp_name = XMPHandler.sidecar_name_for_image(image_filename, prefer_exact_filenames)
         print ("creating xmp sidecar file at ",xmp_name)
-        with open(xmp_name, 'w') as f:
-            f.write(str(soup))
+        SidecarWriter.write_atomic(xmp_name, XMPHandler.new_sidecar_content(image_filename))
         return xmp_name
 
+    @staticmethod
+    def parse(source):
+        """
+        Parses an XMP file (path or binary file object). Returns the lxml tree and a dict of the namespace
+        declarations of each element as (prefix, uri) lists, which lxml doesn't keep track of by itself.
+        """
+        declarations = {}
+        pending = []
+        context = etree.iterparse(source, events=("start-ns", "start"), recover=True,
+                                  resolve_entities=False, no_network=True)
+        for event, value in context:
+            if event == "start-ns":
+                pending.append(value)
+            elif len(pending) > 0:
+                declarations[value] = pending
+                pending = []
+        if context.root is None:
+            raise ValueError("no XML content found")
+        return context.root.getroottree(), declarations
 
-    def __init__(self, xmp_file_path):
+    @staticmethod
+    def serialize_document(document, declarations):
+        # writes XMP the same way the BeautifulSoup based handler used to do
+        parts = ['<?xml version="1.0" encoding="utf-8"?>\n']
+        root = document.getroot()
+        top_level = list(reversed(list(root.itersiblings(preceding=True)))) + [root] + list(root.itersiblings())
+        for node in top_level:
+            XMPHandler.serialize_node(node, declarations, parts)
+        return "".join(parts)
 
-        self.path = xmp_file_path
+    @staticmethod
+    def serialize_node(node, declarations, parts):
+        if node.tag is etree.Comment:
+            parts.append("<!--" + node.text + "-->")
+        elif node.tag is etree.PI:
+            parts.append("<?" + node.target + " " + (node.text or "") + "?>")
+        elif isinstance(node.tag, str):
+            name = XMPHandler.qualified_name(node, node.tag)
+            attributes = []
+            for key, value in node.attrib.items():
+                attributes.append((XMPHandler.qualified_name(node, key), value))
+            for prefix, uri in declarations.get(node, []):
+                attributes.append(("xmlns:" + prefix if prefix else "xmlns", uri))
+            parts.append("<" + name)
+            for key, value in sorted(attributes):
+                parts.append(" " + key + "=" + XMPHandler.quote_attribute(value))
+            if node.text is None and len(node) == 0:
+                parts.append("/>")
+            else:
+                parts.append(">")
+                XMPHandler.serialize_text(node.text, parts)
+                for child in node:
+                    XMPHandler.serialize_node(child, declarations, parts)
+                parts.append("</" + name + ">")
+        XMPHandler.serialize_text(node.tail if node.getparent() is not None else None, parts)
 
-        with open(xmp_file_path, 'r') as f:
-            data = f.read()
-            self.soup = BeautifulSoup(data, "xml")
+    @staticmethod
+    def serialize_text(text, parts):
+        if not text:
+            return
+        if text.translate(XML_SPACES) == "":
+            # whitespace between elements collapses to a single newline or space
+            parts.append("\n" if "\n" in text else " ")
+        else:
+            parts.append(XMPHandler.escape(text))
 
-        self.ensure_namespace("xmlns:dc", "http://purl.org/dc/elements/1.1/")
-        self.subject = self.ensure_keyword_bag("dc:subject")
+    @staticmethod
+    def escape(text):
+        return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
-        self.ensure_namespace("xmlns:lr", "http://ns.adobe.com/lightroom/1.0/")
-        self.hierarchical_subject = self.ensure_keyword_bag("lr:hierarchicalSubject")
+    @staticmethod
+    def quote_attribute(value):
+        value = XMPHandler.escape(value)
+        if '"' not in value:
+            return '"' + value + '"'
+        if "'" not in value:
+            return "'" + value + "'"
+        return '"' + value.replace('"', "&quot;") + '"'
 
-    def has_subject_prefix(self, prefix):
-        subjects = None
-        if self.subject("rdf:Bag"):                      # unfortunately, we have to account for the piece of
-            subjects = self.subject("rdf:Bag")[0]        # useless junk that ON1 photo raw is, because it uses
-        elif self.subject("rdf:Seq"):                    # seq instead of bag like everyone else....
-            subjects = self.subject("rdf:Seq")[0]
-        if subjects is None:
-            return False
-        for i in subjects("rdf:li"):
-            if i.string.lower() == prefix.lower():
-                return True
+    @staticmethod
+    def qualified_name(node, clark_name):
+        qname = etree.QName(clark_name)
+        if qname.namespace is None:
+            return qname.localname
+        if qname.namespace == XML:
+            return "xml:" + qname.localname
+        prefix = None
+        for p, uri in node.nsmap.items():
+            if uri == qname.namespace and (prefix is None or p is not None):
+                prefix = p
+        if prefix is None:
+            return qname.localname
+        return prefix + ":" + qname.localname
+
+    @staticmethod
+    def list_item_string(li):
+        # the text of an rdf:li, None if it doesn't contain exactly one piece of text
+        if len(li) == 0:
+            return li.text
+        if len(li) == 1 and not li.text and not li[0].tail and isinstance(li[0].tag, str):
+            return XMPHandler.list_item_string(li[0])
+        return None
+
+    @staticmethod
+    def file_has_subject_prefix(xmp_file_path, prefix):
+        """
+        Same as XMPHandler(xmp_file_path).has_subject_prefix(prefix), but without building a tree
+        for the whole file: stops as soon as the prefix is found or the first dc:subject ends.
+        """
+        prefix = prefix.lower()
+        subject_tag = "{%s}subject" % DC
+        li_tag = "{%s}li" % RDF
+        in_subject = False
+        for event, element in etree.iterparse(xmp_file_path, events=("start", "end"), recover=True,
+                                              resolve_entities=False, no_network=True):
+            if event == "start":
+                if element.tag == subject_tag:
+                    in_subject = True
+                continue
+            if element.tag == subject_tag:
+                return False
+            if in_subject and element.tag == li_tag:
+                value = XMPHandler.list_item_string(element)
+                if value is not None and value.lower() == prefix:
+                    return True
+            elif not in_subject:
+                # nothing outside of dc:subject is needed, keep the memory footprint small
+                element.clear()
         return False
 
+    def __init__(self, xmp_file_path, content=None):
+        # content: XMP to use instead of the contents of the file, for sidecars not written yet
+
+        self.path = xmp_file_path
+        self.original = None
+        if content is None:
+            with open(xmp_file_path, 'rb') as f:
+                self.original = f.read()
+            content = self.original
+        elif isinstance(content, str):
+            content = content.encode("utf-8")
+        self.document, self.declarations = XMPHandler.parse(io.BytesIO(content))
+        self.description = next(self.document.getroot().iter("{%s}Description" % RDF), None)
+        if self.description is None:
+            raise ValueError("no rdf:Description found in " + xmp_file_path)
+
+        self.ensure_namespace("dc", DC)
+        self.subject = self.ensure_keyword_bag("{%s}subject" % DC)
+        self.subject_list = self.keyword_list(self.subject)
+        self.subject_values = set(XMPHandler.list_item_string(li) for li in self.subject_list.iter("{%s}li" % RDF))
+        self.subject_values_lower = set(v.lower() for v in self.subject_values if v is not None)
+
+        self.ensure_namespace("lr", LR)
+        self.hierarchical_subject = self.ensure_keyword_bag("{%s}hierarchicalSubject" % LR)
+        self.hierarchical_subject_list = self.keyword_list(self.hierarchical_subject)
+        self.hierarchical_subject_values = set(XMPHandler.list_item_string(li) for li in self.hierarchical_subject_list)
+
+    def has_subject_prefix(self, prefix):
+        return prefix.lower() in self.subject_values_lower
+
+    def keyword_list(self, keyword_element):
+        # unfortunately, we have to account for the piece of useless junk that ON1 photo raw is,
+        # because it uses seq instead of bag like everyone else....
+        for container in ["Bag", "Seq"]:
+            found = next(keyword_element.iter("{%s}%s" % (RDF, container)), None)
+            if found is not None:
+                return found
+        return etree.SubElement(keyword_element, "{%s}Bag" % RDF)
+
     def ensure_keyword_bag(self, kw_tag):
-        desc = self.soup("rdf:Description")[0]
-        if len(self.soup(kw_tag)) == 0:
-            subj = self.soup.new_tag(kw_tag)
-            bag = self.soup.new_tag("rdf:Bag")
-            subj.append(bag)
-            desc.append(subj)
-        return self.soup(kw_tag)[0]
-
-    def ensure_namespace(self, namespace, url):
-        desc = self.soup("rdf:Description")[0]
-        try:
-            _ = desc[namespace]
-        except KeyError:
-            desc[namespace] = url
-
-    def save(self):
-        print ("writing to ",self.path)
-        if len(str(self.soup))==0:
-            print ("ERROR: soup creation failed. not writing XMP file")
+        found = next(self.document.getroot().iter(kw_tag), None)
+        if found is not None:
+            return found
+        subj = etree.SubElement(self.description, kw_tag)
+        etree.SubElement(subj, "{%s}Bag" % RDF)
+        return subj
+
+    def ensure_namespace(self, prefix, url):
+        desc = self.description
+        own = self.declarations.get(desc, [])
+        if any(p == prefix for p, _ in own):
+            return
+        self.declarations[desc] = own + [(prefix, url)]
+        if desc.nsmap.get(prefix) == url:
             return
-        with open(self.path, 'w') as f:
-            f.write(str(self.soup))
-            
+        # lxml can't add namespaces to an existing element, so the description has to be replaced
+        nsmap = dict((p, u) for p, u in own)
+        nsmap[prefix] = url
+        new_desc = etree.Element(desc.tag, attrib=dict(desc.attrib), nsmap=nsmap)
+        new_desc.text = desc.text
+        new_desc.tail = desc.tail
+        new_desc.extend(list(desc))
+        desc.getparent().replace(desc, new_desc)
+        self.declarations[new_desc] = self.declarations.pop(desc)
+        self.description = new_desc
+
+    def serialize(self):
+        return XMPHandler.serialize_document(self.document, self.declarations)
+
+    def save(self, verbose=True):
+        content = self.serialize()
+        if SidecarWriter.write_atomic(self.path, content, self.original):
+            if verbose:
+                print ("writing to ",self.path)
+        elif verbose:
+            print ("no changes for ",self.path)
+        self.original = content.encode("utf-8")
+
     def add_single_subject(self, new_subject):
-        subjects = None
-        if self.subject("rdf:Bag"):                      
-            subjects = self.subject("rdf:Bag")[0]       # see above  
-        elif self.subject("rdf:Seq"):                    
-            subjects = self.subject("rdf:Seq")[0]
-        for i in subjects("rdf:li"):
-            if i.string == new_subject:
-                return
-        newTag = self.soup.new_tag("rdf:li")
-        newTag.string = new_subject
-        subjects.append (newTag)
-        
+        if new_subject in self.subject_values:
+            return
+        new_tag = etree.SubElement(self.subject_list, "{%s}li" % RDF)
+        new_tag.text = new_subject
+        self.subject_values.add(new_subject)
+        self.subject_values_lower.add(new_subject.lower())
+
     def add_hierarchical_subject(self, hs):
-        subjects = None
-        if self.hierarchical_subject("rdf:Bag"):
-            subjects = self.hierarchical_subject("rdf:Bag")[0]
-        elif self.hierarchical_subject("rdf:Seq"):
-            subjects = self.hierarchical_subject("rdf:Seq")[0]
-        for i in subjects:
-            if i.string == hs:
-                return
-        new_tag = self.soup.new_tag("rdf:li")
-        new_tag.string = hs
-        subjects.append (new_tag)
+        if hs in self.hierarchical_subject_values:
+            return
+        new_tag = etree.SubElement(self.hierarchical_subject_list, "{%s}li" % RDF)
+        new_tag.text = hs
+        self.hierarchical_subject_values.add(hs)
         subjects = hs.split("|")
         for s in subjects:
             self.add_single_subject(s)
 
+    def remove_hierarchical_subjects(self, prefix, keep=()):
+        # removes prefix|tag for every tag not in keep. The flat dc:subject keywords are left alone,
+        # there is no telling whether a keyword was added by STAG or by the user
+        keep = set(prefix + "|" + t for t in keep)
+        for li in list(self.hierarchical_subject_list):
+            value = XMPHandler.list_item_string(li)
+            if value is not None and value.lower().startswith(prefix.lower() + "|") and value not in keep:
+                self.hierarchical_subject_list.remove(li)
+                self.hierarchical_subject_values.discard(value)
+
     def strip_date_time_original(self):
-        desc = self.soup("rdf:Description")[0]
-        try:
-            del desc["exif:DateTimeOriginal"]
-        except KeyError:
-            pass
+        self.description.attrib.pop("{%s}DateTimeOriginal" % EXIF, None)
 
     def set_output_path(self, new_path):
         self.path = new_path
 
 if __name__ == '__main__':
-    print (XMPHandler.get_xmp_sidecars_for_image("test/P1012424.ORF"))
\ No newline at end of file
+    print (XMPHandler.get_xmp_sidecars_for_image("test/P1012424.ORF"))